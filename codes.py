@@ -858,3 +858,167 @@ HIDCODES = {
     "KEY_MEDIA_REFRESH": 0xfa,
     "KEY_MEDIA_CALC": 0xfb,
 }
+
+# hid-input's consumer page (0x0C) usage -> evdev key map, from
+# hidinput_configure_usage() in drivers/hid/hid-input.c. Some keys come from
+# more than one usage.
+HID_INPUT_CONSUMER_KEYS = (
+    (0x030, "KEY_POWER"),
+    (0x031, "KEY_RESTART"),
+    (0x032, "KEY_SLEEP"),
+    (0x034, "KEY_SLEEP"),
+    (0x035, "KEY_KBDILLUMTOGGLE"),
+    (0x040, "KEY_MENU"),
+    (0x041, "KEY_SELECT"),
+    (0x042, "KEY_UP"),
+    (0x043, "KEY_DOWN"),
+    (0x044, "KEY_LEFT"),
+    (0x045, "KEY_RIGHT"),
+    (0x046, "KEY_ESC"),
+    (0x047, "KEY_KPPLUS"),
+    (0x048, "KEY_KPMINUS"),
+    (0x060, "KEY_INFO"),
+    (0x061, "KEY_SUBTITLE"),
+    (0x065, "KEY_CAMERA"),
+    (0x069, "KEY_RED"),
+    (0x06a, "KEY_GREEN"),
+    (0x06b, "KEY_BLUE"),
+    (0x06c, "KEY_YELLOW"),
+    (0x06d, "KEY_ASPECT_RATIO"),
+    (0x06f, "KEY_BRIGHTNESSUP"),
+    (0x070, "KEY_BRIGHTNESSDOWN"),
+    (0x072, "KEY_BRIGHTNESS_TOGGLE"),
+    (0x073, "KEY_BRIGHTNESS_MIN"),
+    (0x074, "KEY_BRIGHTNESS_MAX"),
+    (0x075, "KEY_BRIGHTNESS_AUTO"),
+    (0x079, "KEY_KBDILLUMUP"),
+    (0x07a, "KEY_KBDILLUMDOWN"),
+    (0x07c, "KEY_KBDILLUMTOGGLE"),
+    (0x082, "KEY_VIDEO_NEXT"),
+    (0x083, "KEY_LAST"),
+    (0x084, "KEY_ENTER"),
+    (0x088, "KEY_PC"),
+    (0x089, "KEY_TV"),
+    (0x08a, "KEY_WWW"),
+    (0x08b, "KEY_DVD"),
+    (0x08c, "KEY_PHONE"),
+    (0x08d, "KEY_PROGRAM"),
+    (0x08e, "KEY_VIDEOPHONE"),
+    (0x08f, "KEY_GAMES"),
+    (0x090, "KEY_MEMO"),
+    (0x091, "KEY_CD"),
+    (0x092, "KEY_VCR"),
+    (0x093, "KEY_TUNER"),
+    (0x094, "KEY_EXIT"),
+    (0x095, "KEY_HELP"),
+    (0x096, "KEY_TAPE"),
+    (0x097, "KEY_TV2"),
+    (0x098, "KEY_SAT"),
+    (0x09a, "KEY_PVR"),
+    (0x09c, "KEY_CHANNELUP"),
+    (0x09d, "KEY_CHANNELDOWN"),
+    (0x0a0, "KEY_VCR2"),
+    (0x0b0, "KEY_PLAY"),
+    (0x0b1, "KEY_PAUSE"),
+    (0x0b2, "KEY_RECORD"),
+    (0x0b3, "KEY_FASTFORWARD"),
+    (0x0b4, "KEY_REWIND"),
+    (0x0b5, "KEY_NEXTSONG"),
+    (0x0b6, "KEY_PREVIOUSSONG"),
+    (0x0b7, "KEY_STOPCD"),
+    (0x0b8, "KEY_EJECTCD"),
+    (0x0b9, "KEY_SHUFFLE"),
+    (0x0bc, "KEY_MEDIA_REPEAT"),
+    (0x0bf, "KEY_SLOW"),
+    (0x0cd, "KEY_PLAYPAUSE"),
+    (0x0cf, "KEY_VOICECOMMAND"),
+    (0x0e2, "KEY_MUTE"),
+    (0x0e5, "KEY_BASSBOOST"),
+    (0x0e9, "KEY_VOLUMEUP"),
+    (0x0ea, "KEY_VOLUMEDOWN"),
+    (0x0f5, "KEY_SLOW"),
+    (0x181, "KEY_BUTTONCONFIG"),
+    (0x182, "KEY_BOOKMARKS"),
+    (0x183, "KEY_CONFIG"),
+    (0x184, "KEY_WORDPROCESSOR"),
+    (0x185, "KEY_EDITOR"),
+    (0x186, "KEY_SPREADSHEET"),
+    (0x187, "KEY_GRAPHICSEDITOR"),
+    (0x188, "KEY_PRESENTATION"),
+    (0x189, "KEY_DATABASE"),
+    (0x18a, "KEY_MAIL"),
+    (0x18b, "KEY_NEWS"),
+    (0x18c, "KEY_VOICEMAIL"),
+    (0x18d, "KEY_ADDRESSBOOK"),
+    (0x18e, "KEY_CALENDAR"),
+    (0x18f, "KEY_TASKMANAGER"),
+    (0x190, "KEY_JOURNAL"),
+    (0x191, "KEY_FINANCE"),
+    (0x192, "KEY_CALC"),
+    (0x193, "KEY_PLAYER"),
+    (0x194, "KEY_FILE"),
+    (0x196, "KEY_WWW"),
+    (0x199, "KEY_CHAT"),
+    (0x19c, "KEY_LOGOFF"),
+    (0x19e, "KEY_COFFEE"),
+    (0x19f, "KEY_CONTROLPANEL"),
+    (0x1a2, "KEY_APPSELECT"),
+    (0x1a3, "KEY_NEXT"),
+    (0x1a4, "KEY_PREVIOUS"),
+    (0x1a6, "KEY_HELP"),
+    (0x1a7, "KEY_DOCUMENTS"),
+    (0x1ab, "KEY_SPELLCHECK"),
+    (0x1ae, "KEY_KEYBOARD"),
+    (0x1b1, "KEY_SCREENSAVER"),
+    (0x1b4, "KEY_FILE"),
+    (0x1b6, "KEY_IMAGES"),
+    (0x1b7, "KEY_AUDIO"),
+    (0x1b8, "KEY_VIDEO"),
+    (0x1bc, "KEY_MESSENGER"),
+    (0x1bd, "KEY_INFO"),
+    (0x201, "KEY_NEW"),
+    (0x202, "KEY_OPEN"),
+    (0x203, "KEY_CLOSE"),
+    (0x204, "KEY_EXIT"),
+    (0x207, "KEY_SAVE"),
+    (0x208, "KEY_PRINT"),
+    (0x209, "KEY_PROPS"),
+    (0x21a, "KEY_UNDO"),
+    (0x21b, "KEY_COPY"),
+    (0x21c, "KEY_CUT"),
+    (0x21d, "KEY_PASTE"),
+    (0x21f, "KEY_FIND"),
+    (0x221, "KEY_SEARCH"),
+    (0x222, "KEY_GOTO"),
+    (0x223, "KEY_HOMEPAGE"),
+    (0x224, "KEY_BACK"),
+    (0x225, "KEY_FORWARD"),
+    (0x226, "KEY_STOP"),
+    (0x227, "KEY_REFRESH"),
+    (0x22a, "KEY_BOOKMARKS"),
+    (0x22d, "KEY_ZOOMIN"),
+    (0x22e, "KEY_ZOOMOUT"),
+    (0x22f, "KEY_ZOOMRESET"),
+    (0x233, "KEY_SCROLLUP"),
+    (0x234, "KEY_SCROLLDOWN"),
+    (0x23d, "KEY_EDIT"),
+    (0x25f, "KEY_CANCEL"),
+    (0x269, "KEY_INSERT"),
+    (0x26a, "KEY_DELETE"),
+    (0x279, "KEY_REDO"),
+    (0x289, "KEY_REPLY"),
+    (0x28b, "KEY_FORWARDMAIL"),
+    (0x28c, "KEY_SEND"),
+)
+
+# Keys hid-input also maps from the keyboard page, but that are sent as
+# consumer usages since they are what remotes and media keys send. Other keys
+# on both pages (arrows, Enter, Copy, ...) stay keyboard keys.
+CONSUMER_KEYBOARD_KEYS = ("KEY_POWER", "KEY_PAUSE", "KEY_MUTE", "KEY_VOLUMEUP", "KEY_VOLUMEDOWN")
+
+# evdev key name -> consumer page usage, the inverse of HID_INPUT_CONSUMER_KEYS
+# (the first usage of a key wins), so keys round-trip through a Linux host
+CONSUMERCODES = dict(
+    (name, usage) for usage, name in reversed(HID_INPUT_CONSUMER_KEYS)
+    if name in SCANCODES and (name not in HIDCODES or name in CONSUMER_KEYBOARD_KEYS)
+)
@@ -0,0 +1,208 @@
+'''HID report formats used by the bridge, and the report descriptors for them
+
+hid_bridge packs its reports from these definitions and gadget writes the
+descriptors generated from them, so the two can't drift apart.
+'''
+
+import struct
+
+
+## Report Formats
+
+# Boot keyboard: [modifier bitmask, reserved, KEYBOARD_KEYS held usages]
+KEYBOARD_KEYS = 6
+KEYBOARD_KEYS_OFFSET = 2
+KEYBOARD_REPORT_SIZE = KEYBOARD_KEYS_OFFSET + KEYBOARD_KEYS
+
+# Highest keyboard page usage a key can send (modifiers have their own byte)
+KEYBOARD_USAGE_MAX = 0xdf
+
+# N-key rollover keyboard: [modifier bitmask, one bit per usage 0..KEYBOARD_USAGE_MAX]
+NKRO_BITMAP_OFFSET = 1
+NKRO_REPORT_SIZE = NKRO_BITMAP_OFFSET + (KEYBOARD_USAGE_MAX + 1) // 8
+
+# Mouse: [button bitmask, x, y, wheel], motion as signed bytes
+MOUSE_BUTTONS = 5
+MOUSE_AXIS_MAX = 127
+MOUSE_REPORT_FORMAT = "<Bbbb"
+MOUSE_REPORT_SIZE = struct.calcsize(MOUSE_REPORT_FORMAT)
+
+# Consumer control: one 16-bit consumer page usage (0 when nothing is held)
+CONSUMER_USAGE_MAX = 0x3ff
+CONSUMER_REPORT_FORMAT = "<H"
+CONSUMER_REPORT_SIZE = struct.calcsize(CONSUMER_REPORT_FORMAT)
+
+
+## Descriptor Items
+
+USAGE_PAGE = 0x04
+LOGICAL_MIN = 0x14
+LOGICAL_MAX = 0x24
+REPORT_SIZE = 0x74
+REPORT_COUNT = 0x94
+USAGE = 0x08
+USAGE_MIN = 0x18
+USAGE_MAX = 0x28
+INPUT = 0x80
+OUTPUT = 0x90
+COLLECTION = 0xa0
+END_COLLECTION = 0xc0
+
+PAGE_GENERIC_DESKTOP = 0x01
+PAGE_KEYBOARD = 0x07
+PAGE_LEDS = 0x08
+PAGE_BUTTON = 0x09
+PAGE_CONSUMER = 0x0c
+
+# Input/Output flags
+DATA_ARRAY = 0x00
+CONSTANT = 0x01
+DATA_VARIABLE = 0x02
+DATA_VARIABLE_RELATIVE = 0x06
+
+# Logical min/max are signed, every other item here is unsigned
+SIGNED_ITEMS = (LOGICAL_MIN, LOGICAL_MAX)
+
+
+def item(tag, value=None):
+    '''Encode a short item, using the smallest data size that holds 'value' '''
+    if value is None:
+        return bytearray([tag])
+
+    formats = ("<b", "<h", "<i") if tag in SIGNED_ITEMS else ("<B", "<H", "<I")
+
+    # Size codes 1, 2 and 3 mean 1, 2 and 4 data bytes
+    for code, fmt in enumerate(formats, 1):
+        try:
+            data = struct.pack(fmt, value)
+        except struct.error:
+            continue
+        return bytearray([tag | code]) + bytearray(data)
+
+    raise ValueError("Item value out of range: {}".format(value))
+
+
+def descriptor(items):
+    '''Join (tag, value) and (tag,) items into a report descriptor'''
+    out = bytearray()
+    for it in items:
+        out += item(*it)
+    return bytes(out)
+
+
+def _led_output():
+    return [
+        (USAGE_PAGE, PAGE_LEDS),
+        (USAGE_MIN, 0x01),          # Num Lock
+        (USAGE_MAX, 0x05),          # Kana
+        (REPORT_SIZE, 1),
+        (REPORT_COUNT, 5),
+        (OUTPUT, DATA_VARIABLE),
+        (REPORT_SIZE, 3),
+        (REPORT_COUNT, 1),
+        (OUTPUT, CONSTANT),
+    ]
+
+
+def _modifier_input():
+    return [
+        (USAGE_PAGE, PAGE_KEYBOARD),
+        (USAGE_MIN, 0xe0),          # Left Control
+        (USAGE_MAX, 0xe7),          # Right GUI
+        (LOGICAL_MIN, 0),
+        (LOGICAL_MAX, 1),
+        (REPORT_SIZE, 1),
+        (REPORT_COUNT, 8),
+        (INPUT, DATA_VARIABLE),
+    ]
+
+
+## Report Descriptors
+
+def keyboard_descriptor():
+    '''Boot keyboard report descriptor'''
+    return descriptor([
+        (USAGE_PAGE, PAGE_GENERIC_DESKTOP),
+        (USAGE, 0x06),              # Keyboard
+        (COLLECTION, 0x01),         # Application
+    ] + _modifier_input() + [
+        (REPORT_SIZE, 8),           # Reserved byte
+        (REPORT_COUNT, 1),
+        (INPUT, CONSTANT),
+    ] + _led_output() + [
+        (USAGE_PAGE, PAGE_KEYBOARD),
+        (USAGE_MIN, 0),
+        (USAGE_MAX, KEYBOARD_USAGE_MAX),
+        (LOGICAL_MIN, 0),
+        (LOGICAL_MAX, KEYBOARD_USAGE_MAX),
+        (REPORT_SIZE, 8),
+        (REPORT_COUNT, KEYBOARD_KEYS),
+        (INPUT, DATA_ARRAY),
+        (END_COLLECTION,),
+    ])
+
+
+def nkro_descriptor():
+    '''N-key rollover keyboard report descriptor (report protocol only)'''
+    return descriptor([
+        (USAGE_PAGE, PAGE_GENERIC_DESKTOP),
+        (USAGE, 0x06),              # Keyboard
+        (COLLECTION, 0x01),         # Application
+    ] + _modifier_input() + [
+        (USAGE_MIN, 0),
+        (USAGE_MAX, KEYBOARD_USAGE_MAX),
+        (REPORT_COUNT, KEYBOARD_USAGE_MAX + 1),
+        (INPUT, DATA_VARIABLE),
+    ] + _led_output() + [
+        (END_COLLECTION,),
+    ])
+
+
+def mouse_descriptor():
+    '''Boot mouse report descriptor, with a wheel'''
+    return descriptor([
+        (USAGE_PAGE, PAGE_GENERIC_DESKTOP),
+        (USAGE, 0x02),              # Mouse
+        (COLLECTION, 0x01),         # Application
+        (USAGE, 0x01),              # Pointer
+        (COLLECTION, 0x00),         # Physical
+        (USAGE_PAGE, PAGE_BUTTON),
+        (USAGE_MIN, 1),
+        (USAGE_MAX, MOUSE_BUTTONS),
+        (LOGICAL_MIN, 0),
+        (LOGICAL_MAX, 1),
+        (REPORT_SIZE, 1),
+        (REPORT_COUNT, MOUSE_BUTTONS),
+        (INPUT, DATA_VARIABLE),
+        (REPORT_SIZE, 8 - MOUSE_BUTTONS),
+        (REPORT_COUNT, 1),
+        (INPUT, CONSTANT),
+        (USAGE_PAGE, PAGE_GENERIC_DESKTOP),
+        (USAGE, 0x30),              # X
+        (USAGE, 0x31),              # Y
+        (USAGE, 0x38),              # Wheel
+        (LOGICAL_MIN, -MOUSE_AXIS_MAX),
+        (LOGICAL_MAX, MOUSE_AXIS_MAX),
+        (REPORT_SIZE, 8),
+        (REPORT_COUNT, 3),
+        (INPUT, DATA_VARIABLE_RELATIVE),
+        (END_COLLECTION,),
+        (END_COLLECTION,),
+    ])
+
+
+def consumer_descriptor():
+    '''Consumer control report descriptor, one usage at a time'''
+    return descriptor([
+        (USAGE_PAGE, PAGE_CONSUMER),
+        (USAGE, 0x01),              # Consumer Control
+        (COLLECTION, 0x01),         # Application
+        (USAGE_MIN, 0),
+        (USAGE_MAX, CONSUMER_USAGE_MAX),
+        (LOGICAL_MIN, 0),
+        (LOGICAL_MAX, CONSUMER_USAGE_MAX),
+        (REPORT_SIZE, 8 * CONSUMER_REPORT_SIZE),
+        (REPORT_COUNT, 1),
+        (INPUT, DATA_ARRAY),
+        (END_COLLECTION,),
+    ])
@@ -0,0 +1,211 @@
+#!python
+'''Create or remove the bridge's composite USB HID gadget through configfs
+
+Usage: gadget.py [up|down]
+
+Each HID function becomes a /dev/hidgN node, numbered in the order the
+functions are created: keyboard, then mouse, then consumer control.
+'''
+
+from __future__ import print_function
+import errno
+import os
+import sys
+
+import descriptors
+
+
+## Constants
+
+# Where configfs is mounted. Point this at a temp directory to try it out;
+# create() and remove() work there too.
+CONFIGFS_PATH = "/sys/kernel/config"
+
+# Directory listing the USB device controllers the gadget can bind to
+UDC_CLASS_PATH = "/sys/class/udc"
+
+GADGET_NAME = "bt_hid_bridge"
+
+# Linux Foundation, Multifunction Composite Gadget
+VENDOR_ID = 0x1d6b
+PRODUCT_ID = 0x0104
+
+MANUFACTURER = "bt-hid-bridge"
+PRODUCT = "Bluetooth HID Bridge"
+SERIAL_NUMBER = "0123456789"
+
+# Bus powered, remote wakeup
+CONFIG_ATTRIBUTES = 0xa0
+MAX_POWER_MA = 250
+
+# HID functions to create, in /dev/hidgN order
+FUNCTIONS = ("keyboard", "mouse", "consumer")
+
+# Use the N-key rollover descriptor for the keyboard (see hid_bridge.KB_NKRO)
+NKRO = False
+
+
+## Functions
+
+def hid_functions(functions=FUNCTIONS, nkro=NKRO):
+    '''List of (name, protocol, subclass, report length, report descriptor)'''
+
+    if nkro:
+        keyboard = (0, 0, descriptors.NKRO_REPORT_SIZE, descriptors.nkro_descriptor())
+    else:
+        keyboard = (1, 1, descriptors.KEYBOARD_REPORT_SIZE,
+            descriptors.keyboard_descriptor())
+
+    known = {
+        "keyboard": keyboard,
+        "mouse": (2, 1, descriptors.MOUSE_REPORT_SIZE, descriptors.mouse_descriptor()),
+        "consumer": (0, 0, descriptors.CONSUMER_REPORT_SIZE,
+            descriptors.consumer_descriptor()),
+    }
+
+    return [(name,) + known[name] for name in functions]
+
+
+def gadget_path(configfs=CONFIGFS_PATH, name=GADGET_NAME):
+    return os.path.join(configfs, "usb_gadget", name)
+
+
+def _write(path, value, mode="w"):
+    with open(path, mode) as f:
+        f.write(value)
+
+
+def _mkdir(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+def _rmdir(path):
+    '''Remove a configfs directory
+
+    configfs takes a directory's attribute files and default groups with it.
+    A plain directory standing in for configfs needs them removed first.
+    '''
+    try:
+        os.rmdir(path)
+    except OSError as e:
+        if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+            raise
+
+        for entry in os.listdir(path):
+            entry = os.path.join(path, entry)
+            if os.path.isdir(entry) and not os.path.islink(entry):
+                _rmdir(entry)
+            else:
+                os.unlink(entry)
+        os.rmdir(path)
+
+
+def _bound_udc(gadget):
+    '''Name of the UDC the gadget is bound to, or "" if it isn't bound'''
+    try:
+        with open(os.path.join(gadget, "UDC")) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return ""
+
+
+def _unbind(gadget):
+    # Writing an empty UDC to an unbound gadget fails with ENODEV
+    if _bound_udc(gadget):
+        _write(os.path.join(gadget, "UDC"), "\n")
+
+
+def find_udc(udc_class=UDC_CLASS_PATH):
+    '''Name of the first USB device controller, or None'''
+    try:
+        names = sorted(os.listdir(udc_class))
+    except OSError:
+        return None
+    return names[0] if names else None
+
+
+def create(functions=FUNCTIONS, nkro=NKRO, configfs=CONFIGFS_PATH, name=GADGET_NAME,
+        udc=None):
+    '''Create the gadget and bind it to 'udc' (found automatically if None, skipped if "")
+
+    Returns the gadget's configfs path.
+    '''
+
+    gadget = _mkdir(gadget_path(configfs, name))
+
+    # Function attributes can't be changed while the gadget is bound (EBUSY)
+    _unbind(gadget)
+
+    _write(os.path.join(gadget, "idVendor"), "0x{:04x}".format(VENDOR_ID))
+    _write(os.path.join(gadget, "idProduct"), "0x{:04x}".format(PRODUCT_ID))
+    _write(os.path.join(gadget, "bcdDevice"), "0x0100")
+    _write(os.path.join(gadget, "bcdUSB"), "0x0200")
+
+    strings = _mkdir(os.path.join(gadget, "strings", "0x409"))
+    _write(os.path.join(strings, "serialnumber"), SERIAL_NUMBER)
+    _write(os.path.join(strings, "manufacturer"), MANUFACTURER)
+    _write(os.path.join(strings, "product"), PRODUCT)
+
+    config = _mkdir(os.path.join(gadget, "configs", "c.1"))
+    _write(os.path.join(_mkdir(os.path.join(config, "strings", "0x409")), "configuration"),
+        "HID")
+    _write(os.path.join(config, "bmAttributes"), "0x{:02x}".format(CONFIG_ATTRIBUTES))
+    _write(os.path.join(config, "MaxPower"), str(MAX_POWER_MA))
+
+    for i, (fname, protocol, subclass, length, desc) in enumerate(
+            hid_functions(functions, nkro)):
+        func = _mkdir(os.path.join(gadget, "functions", "hid.usb{}".format(i)))
+        _write(os.path.join(func, "protocol"), str(protocol))
+        _write(os.path.join(func, "subclass"), str(subclass))
+        _write(os.path.join(func, "report_length"), str(length))
+        _write(os.path.join(func, "report_desc"), desc, "wb")
+
+        link = os.path.join(config, "hid.usb{}".format(i))
+        if not os.path.islink(link):
+            os.symlink(func, link)
+
+        print("Function '{}': hid.usb{}".format(fname, i))
+
+    if udc is None:
+        udc = find_udc()
+    if udc:
+        _write(os.path.join(gadget, "UDC"), udc)
+        print("Bound gadget '{}' to '{}'.".format(name, udc))
+
+    return gadget
+
+
+def remove(configfs=CONFIGFS_PATH, name=GADGET_NAME):
+    '''Unbind the gadget and remove it, in the reverse order of creation'''
+
+    gadget = gadget_path(configfs, name)
+    if not os.path.isdir(gadget):
+        return
+
+    _unbind(gadget)
+
+    config = os.path.join(gadget, "configs", "c.1")
+    for entry in os.listdir(config):
+        if os.path.islink(os.path.join(config, entry)):
+            os.unlink(os.path.join(config, entry))
+
+    _rmdir(os.path.join(config, "strings", "0x409"))
+    _rmdir(config)
+
+    functions = os.path.join(gadget, "functions")
+    for entry in os.listdir(functions):
+        _rmdir(os.path.join(functions, entry))
+
+    _rmdir(os.path.join(gadget, "strings", "0x409"))
+    _rmdir(gadget)
+
+
+## Main
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ["down"]:
+        remove()
+    else:
+        create()
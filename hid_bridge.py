@@ -1,17 +1,30 @@
 #!python
 
 from __future__ import print_function
+import binascii
+import collections
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import heapq
+import itertools
+import json
+import os
 import re
+import select
+import signal
 import struct
 import sys
-import threading
 import time
 import traceback
-from Queue import Queue
 
 import evdev
 
 import codes
+import descriptors
+import gadget
+import keymap
 
 
 ## Constants
@@ -19,6 +32,82 @@ import codes
 # Stop the program when handler raises an error
 HALT_ON_ERROR = False
 
+# Record latency histograms from evdev event to gadget write, printed on SIGUSR1
+# along with the other counters
+TRACE_LATENCY = False
+
+# Key autorepeat: "host" sends keys as held and lets the host repeat them,
+# "none" taps keys (press and release at once) so nothing repeats, and
+# "bridge" taps keys and repeats them itself after AUTOREPEAT_DELAY, every
+# AUTOREPEAT_INTERVAL, timed by the device's own repeat events. Modifiers are
+# always sent as held.
+AUTOREPEAT = "host"
+AUTOREPEAT_DELAY = 0.5
+AUTOREPEAT_INTERVAL = 0.1
+
+# Read input events in batches and send one keyboard report per evdev frame
+COALESCE_FRAMES = True
+
+# Send N-key rollover bitmap reports instead of 6-key boot reports. The
+# keyboard gadget must match (gadget.NKRO).
+KB_NKRO = False
+
+# HID gadget device nodes. None disables the mouse (e.g. '/dev/hidg1') and
+# consumer control (media keys, e.g. '/dev/hidg2') endpoints
+HID_KEYBOARD_PATH = '/dev/hidg0'
+HID_MOUSE_PATH = None
+HID_CONSUMER_PATH = None
+
+# Reports buffered per endpoint while the host isn't reading or is asleep
+REPORT_QUEUE_SIZE = 64
+
+# Times a report is retried after a failed write (e.g. while the gadget is
+# re-enumerating) before it is dropped. Retries follow the writer's backoff.
+HID_WRITE_RETRIES = 5
+
+# USB device controller sysfs directory (e.g. '/sys/class/udc/fe980000.usb'),
+# whose 'state' says whether the host is listening. None finds the first one,
+# "" ignores the host's state.
+UDC_PATH = None
+UDC_POLL_INTERVAL = 0.5
+
+# Ask a suspended host to wake up when input arrives
+REMOTE_WAKEUP = False
+
+# Directory watched for input devices
+INPUT_DEVICE_DIR = "/dev/input"
+
+# Input devices to grab: a device is used if all regexes of any rule match
+# its "name", "phys", "uniq" or "path". Devices must have keys or buttons.
+# Grabbed devices stop working for the rest of the system, so the default
+# only takes Bluetooth devices, whose phys (the adapter) and uniq (the
+# device) are Bluetooth addresses. {} would take every device with keys,
+# including on-board ones like power buttons and GPIO keys.
+BT_ADDRESS_REGEX = r"^[0-9a-fA-F]{2}(:[0-9a-fA-F]{2}){5}$"
+INPUT_DEVICE_RULES = [
+    {"phys": BT_ADDRESS_REGEX, "uniq": BT_ADDRESS_REGEX},
+]
+
+# Input directory rescan period when hotplug notifications are unavailable
+DEVICE_RESCAN_INTERVAL = 1.0
+
+# Key remapping config (see keymap.py), reloaded when it changes. None disables.
+KEYMAP_PATH = os.path.expanduser("~/.bt_hid_bridge_keymap.json")
+
+# Learned translator navigation delays, per app
+PACING_PATH = os.path.expanduser("~/.bt_hid_bridge_pacing.json")
+
+# Delay multipliers after an uncorrected keypress and after a suspected drop
+PACING_DECREASE = 0.99
+PACING_INCREASE = 1.5
+
+# Delay bounds, in seconds
+PACING_MIN = 0.03
+PACING_MAX = 1.0
+
+# A backspace this soon after a translated key means a press was dropped
+PACING_CORRECTION_WINDOW = 5.0
+
 
 # Backup if evdev.ecodes.KEY is ambiguous
 KB_KEYS = {v: k for k, v in codes.SCANCODES.iteritems() if k in codes.HIDCODES}
@@ -35,16 +124,307 @@ KB_MOD_HID_MASK = {
 }
 
 
+def kb_build_hid_table():
+    '''Flat scancode -> HID usage table (0 means no HID code)'''
+    table = bytearray(codes.SCANCODES["KEY_MAX"] + 1)
+    for scancode, name in KB_KEYS.iteritems():
+        table[scancode] = codes.HIDCODES[name]
+    return table
+
+
+def kb_build_mod_table():
+    '''Flat HID usage -> modifier bit table (0 means not a modifier)'''
+    table = bytearray(256)
+    for hk, mask in KB_MOD_HID_MASK.iteritems():
+        table[hk] = mask
+    return table
+
+
+# evdev event types and codes the reader dispatches on
+EV_SYN = codes.SCANCODES["EV_SYN"]
+EV_KEY = codes.SCANCODES["EV_KEY"]
+EV_REL = codes.SCANCODES["EV_REL"]
+SYN_REPORT = codes.SCANCODES["SYN_REPORT"]
+REL_X = codes.SCANCODES["REL_X"]
+REL_Y = codes.SCANCODES["REL_Y"]
+REL_WHEEL = codes.SCANCODES["REL_WHEEL"]
+
+# Number of codes of each event type, for kernel event masks (EVIOCSMASK)
+EV_CODE_COUNTS = {
+    EV_SYN: codes.SCANCODES["EV_MAX"] + 1,  # Type 0's mask holds event types
+    EV_KEY: codes.SCANCODES["KEY_MAX"] + 1,
+    EV_REL: codes.SCANCODES["REL_MAX"] + 1,
+}
+
+# _IOW('E', 0x93, struct input_mask)
+EVIOCSMASK = 0x40104593
+
+# evdev mouse buttons in HID button order (button 1 first)
+MOUSE_BUTTON_ORDER = ("BTN_LEFT", "BTN_RIGHT", "BTN_MIDDLE", "BTN_SIDE", "BTN_EXTRA",
+    "BTN_FORWARD", "BTN_BACK", "BTN_TASK")
+
+# evdev mouse button -> bit in the mouse report's button byte, for the
+# buttons the mouse descriptor declares
+MOUSE_BUTTON_BITS = dict(
+    (codes.SCANCODES[name], 1 << i)
+    for i, name in enumerate(MOUSE_BUTTON_ORDER[:descriptors.MOUSE_BUTTONS])
+)
+
+# evdev scancodes that belong to mice rather than keyboards
+MOUSE_BUTTON_MIN = codes.SCANCODES["BTN_MOUSE"]
+MOUSE_BUTTON_MAX = codes.SCANCODES["BTN_TASK"]
+
+# Where held keys start in boot and N-key rollover keyboard reports
+KB_KEYS_OFFSET = descriptors.KEYBOARD_KEYS_OFFSET
+KB_NKRO_OFFSET = descriptors.NKRO_BITMAP_OFFSET
+
+# Keyboard report with nothing held
+KB_EMPTY_REPORT = bytes(bytearray(
+    descriptors.NKRO_REPORT_SIZE if KB_NKRO else descriptors.KEYBOARD_REPORT_SIZE))
+
+# Consumer control report with no usage pressed
+CC_EMPTY_REPORT = bytes(bytearray(descriptors.CONSUMER_REPORT_SIZE))
+
+# Scancode -> consumer page (0x0C) usage
+CC_USAGE_TABLE = dict(
+    (codes.SCANCODES[name], usage)
+    for name, usage in codes.CONSUMERCODES.iteritems()
+)
+
+# Scancode -> HID usage, indexed by evdev scancode
+KB_HID_TABLE = kb_build_hid_table()
+
+# HID usage -> modifier byte bit, indexed by HID usage
+KB_MOD_TABLE = kb_build_mod_table()
+
+# LatencyTracer, set up at startup if TRACE_LATENCY is on
+TRACER = None
+
+
 ## Classes
 
 class NoHidCodeError(RuntimeError):
     pass
 
 
+class KeyboardState(object):
+    '''Held keys and modifiers, kept as a ready-to-send boot keyboard report'''
+
+    __slots__ = ("report", "input_translation", "translators", "consumer", "repeat_times")
+
+    def __init__(self):
+        # [modifier bitmask, reserved, held keys packed oldest first] (see descriptors)
+        self.report = bytearray(descriptors.KEYBOARD_REPORT_SIZE)
+
+        # Media keys held, if they have their own endpoint (ConsumerState)
+        self.consumer = None
+
+        # Input translation mode
+        self.input_translation = None
+
+        # Translator instances, by class, kept across mode switches
+        self.translators = {}
+
+        # Scancode -> time of its next bridge-generated repeat
+        self.repeat_times = {}
+
+    def press(self, hk):
+        r = self.report
+        r[0] |= KB_MOD_TABLE[hk]
+
+        for i in xrange(KB_KEYS_OFFSET, len(r)):
+            if r[i] == hk:
+                return
+            if r[i] == 0:
+                r[i] = hk
+                return
+
+        # All slots are in use, so drop the oldest key
+        r[KB_KEYS_OFFSET:-1] = r[KB_KEYS_OFFSET + 1:]
+        r[-1] = hk
+
+    def holds(self, hk):
+        mask = KB_MOD_TABLE[hk]
+        if mask:
+            return bool(self.report[0] & mask)
+        return hk in self.report[KB_KEYS_OFFSET:]
+
+    def release(self, hk):
+        r = self.report
+        r[0] &= ~KB_MOD_TABLE[hk] & 0xff
+
+        for i in xrange(KB_KEYS_OFFSET, len(r)):
+            if r[i] == hk:
+                r[i:-1] = r[i + 1:]
+                r[-1] = 0
+                return
+            if r[i] == 0:
+                return
+
+
+class NkroKeyboardState(KeyboardState):
+    '''Keyboard state kept as an N-key rollover bitmap report'''
+
+    __slots__ = ()
+
+    def __init__(self):
+        super(NkroKeyboardState, self).__init__()
+
+        # [modifier bitmask, bitmap of held usages]
+        self.report = bytearray(descriptors.NKRO_REPORT_SIZE)
+
+    def press(self, hk):
+        mask = KB_MOD_TABLE[hk]
+        if mask:
+            self.report[0] |= mask
+        else:
+            self.report[KB_NKRO_OFFSET + (hk >> 3)] |= 1 << (hk & 7)
+
+    def holds(self, hk):
+        mask = KB_MOD_TABLE[hk]
+        if mask:
+            return bool(self.report[0] & mask)
+        return bool(self.report[KB_NKRO_OFFSET + (hk >> 3)] & (1 << (hk & 7)))
+
+    def release(self, hk):
+        mask = KB_MOD_TABLE[hk]
+        if mask:
+            self.report[0] &= ~mask & 0xff
+        else:
+            self.report[KB_NKRO_OFFSET + (hk >> 3)] &= ~(1 << (hk & 7)) & 0xff
+
+
+class ConsumerState(object):
+    '''Consumer control usages held, and the sink their reports go to'''
+
+    __slots__ = ("queue", "held")
+
+    def __init__(self, queue):
+        self.queue = queue
+
+        # Usages held, oldest first. Only the newest one is reported.
+        self.held = []
+
+    def press(self, usage):
+        if usage not in self.held:
+            self.held.append(usage)
+
+    def release(self, usage):
+        if usage in self.held:
+            self.held.remove(usage)
+
+
+class MouseState(object):
+    '''Mouse buttons held, plus motion accumulated over one evdev frame'''
+
+    __slots__ = ("buttons", "dx", "dy", "wheel", "changed")
+
+    def __init__(self):
+        self.buttons = 0
+        self.dx = 0
+        self.dy = 0
+        self.wheel = 0
+
+        # Whether a report is due at the end of the frame
+        self.changed = False
+
+    def button(self, code, value):
+        bit = MOUSE_BUTTON_BITS.get(code, 0)
+        buttons = (self.buttons | bit) if value else (self.buttons & ~bit)
+        if buttons != self.buttons:
+            self.buttons = buttons
+            self.changed = True
+
+    def move(self, code, value):
+        if code == REL_X:
+            self.dx += value
+        elif code == REL_Y:
+            self.dy += value
+        elif code == REL_WHEEL:
+            self.wheel += value
+        else:
+            return
+        self.changed = True
+
+
+class FrameQueue(object):
+    '''Report sink wrapper that coalesces keyboard reports until flush() (SYN_REPORT)'''
+
+    def __init__(self, queue):
+        self._queue = queue
+        self._last = KB_EMPTY_REPORT
+        self._pending = None
+
+    def put(self, report):
+        if self._pending is not None:
+            if kb_report_merge_ok(self._last, self._pending, report):
+                self._pending = report
+                return
+
+            # Replacing the pending report would hide a press or release
+            self._send(self._pending)
+
+        self._pending = report
+
+    def flush(self):
+        if self._pending is not None:
+            if self._pending != self._last:
+                self._send(self._pending)
+            self._pending = None
+
+    def pause(self, seconds):
+        self.flush()
+        self._queue.pause(seconds)
+
+    @property
+    def busy(self):
+        return self._queue.busy
+
+    def cancel(self, report=None):
+        '''Drop scheduled output, leaving 'report' held on the host (see ReportScheduler)
+
+        The frame's pending report carries physical key changes, so it is
+        kept and still sent at flush().
+        '''
+        self._last = self._queue.cancel(report)
+
+    def _send(self, report):
+        self._queue.put(report)
+        self._last = report
+
+
+class Macro(object):
+    '''Key sequence compiled to ready-to-send keyboard reports and pauses'''
+
+    __slots__ = ("name", "steps", "ops", "keys")
+
+    def __init__(self, name, steps, ops):
+        self.name = name
+
+        # Report bytes to send, or float seconds to wait
+        self.steps = tuple(steps)
+
+        # The same sequence as (HID usage, 1 for press or 0 for release) or
+        # float seconds, for replaying on top of keys already held
+        self.ops = tuple(ops)
+
+        # HID usages the macro presses
+        self.keys = frozenset(op[0] for op in self.ops if op.__class__ is tuple)
+
+    def __len__(self):
+        return len(self.steps)
+
+
 class SimKeyEvent(object):
-    def __init__(self, scancode, keystate):
-        self.scancode = scancode
-        self.keystate = keystate
+    '''Synthetic key event, shaped like the raw evdev events handlers get'''
+
+    __slots__ = ("code", "value", "sec", "usec")
+
+    def __init__(self, code, value, sec=0, usec=0):
+        self.code = code
+        self.value = value
+        self.sec = sec
+        self.usec = usec
 
 
 ## Debug Functions
@@ -56,11 +436,15 @@ def eprint(*args, **kwargs):
 ## Pure Functions
 
 def kb_hid_code(scancode):
-    name = kb_key_name(scancode)
     try:
-        return codes.HIDCODES[name]
-    except KeyError:
-        raise NoHidCodeError("No HID code for key '{}' ({})".format(name, scancode))
+        hk = KB_HID_TABLE[scancode]
+    except IndexError:
+        hk = 0
+
+    if not hk:
+        raise NoHidCodeError("No HID code for key '{}' ({})".format(
+            KB_KEYS.get(scancode), scancode))
+    return hk
 
 
 def kb_key_name(scancode, default=None):
@@ -75,83 +459,322 @@ def kb_key_name(scancode, default=None):
         return default
 
 
-def or_values(d):
-    out = 0
-    for k, v in d.iteritems():
-        out = out | v
-    return out
+def kb_report_merge_ok(sent, pending, new):
+    '''True if the host can skip 'pending' and go from 'sent' to 'new' losing no transitions
 
+    Keys pressed in 'pending' must still be held in 'new', and keys released
+    in 'pending' still released.
+    '''
+    if pending == sent or pending == new:
+        return True
 
-def kb_report(state):
-    if len(state["kb_keys"]) != 6:
-        raise RuntimeError("'kb_keys' should be length 6: {}".format(kb_keys))
+    if len(pending) == descriptors.NKRO_REPORT_SIZE:
+        # The whole report is a bitmap (modifier byte included), so compare
+        # all of it at once as integers
+        s = int(binascii.hexlify(sent), 16)
+        p = int(binascii.hexlify(pending), 16)
+        n = int(binascii.hexlify(new), 16)
+        return not (p & ~s & ~n) and not (s & ~p & n)
 
-    return struct.pack("BBBBBBBB", or_values(state["kb_mods"]), 0, *state["kb_keys"])
+    s, p, n = bytearray(sent), bytearray(pending), bytearray(new)
+    if (p[0] & ~s[0] & ~n[0]) or (s[0] & ~p[0] & n[0]):
+        return False
+
+    # Key slots hold usages in press order, so compare them as sets
+    s_keys = set(s[KB_KEYS_OFFSET:])
+    p_keys = set(p[KB_KEYS_OFFSET:])
+    n_keys = set(n[KB_KEYS_OFFSET:])
+    for keys in (s_keys, p_keys, n_keys):
+        keys.discard(0)
+    return (p_keys - s_keys) <= n_keys and not ((s_keys - p_keys) & n_keys)
+
+
+def cc_report_merge_ok(sent, pending, new):
+    '''True if the host can skip consumer report 'pending' without missing a usage'''
+    return pending == sent or pending == new
+
+
+def mouse_report_merge(first, second, lossy=False):
+    '''One report with the motion of both mouse reports, or None
+
+    Reports merge only if they have the same buttons, so no click is lost,
+    and, unless 'lossy', if the summed motion fits in the report.
+    '''
+    fmt = descriptors.MOUSE_REPORT_FORMAT
+    buttons, dx, dy, wheel = struct.unpack(fmt, first)
+    buttons2, dx2, dy2, wheel2 = struct.unpack(fmt, second)
+    if buttons != buttons2:
+        return None
+
+    m = descriptors.MOUSE_AXIS_MAX
+    dx, dy, wheel = dx + dx2, dy + dy2, wheel + wheel2
+    if not lossy and max(abs(dx), abs(dy), abs(wheel)) > m:
+        return None
+
+    return struct.pack(fmt, buttons,
+        max(-m, min(m, dx)), max(-m, min(m, dy)), max(-m, min(m, wheel)))
+
+
+def kb_report(state):
+    return bytes(state.report)
 
 
 def kb_state():
-    return {
-        # Keys currently pressed
-        "kb_keys": [0] * 6,
+    if KB_NKRO:
+        return NkroKeyboardState()
+    return KeyboardState()
 
-        # Modifier keys
-        "kb_mods": {k: 0 for k in KB_MOD_HID_MASK.keys()},
 
-        # Input translation mode
-        "input_translation": None
-    }
+def kb_held(state, scancode):
+    '''Whether the key for 'scancode' is held on the host'''
+    consumer = state.consumer
+    if consumer is not None and scancode in CC_USAGE_TABLE:
+        return CC_USAGE_TABLE[scancode] in consumer.held
+
+    try:
+        hk = KB_HID_TABLE[scancode]
+    except IndexError:
+        return False
+    return bool(hk) and state.holds(hk)
+
+
+def kb_macro_key(name):
+    '''Scancode for a macro key name, e.g. "Up", "KEY_UP" or 103'''
+    if isinstance(name, int):
+        return name
+
+    name = name.strip().upper()
+    if not name.startswith("KEY_"):
+        name = "KEY_" + name
+    try:
+        return codes.SCANCODES[name]
+    except KeyError:
+        raise ValueError("Unknown macro key '{}'".format(name))
+
+
+def kb_macro(spec, delay=0, name=None):
+    '''Compile a key sequence into a Macro
+
+    'spec' is a string like "Up, Up, Right, Enter" or a list of key names and
+    scancodes. Keys joined with '+' (e.g. "LeftShift+A") are held together.
+    "wait:<seconds>" (e.g. "Up, wait:0.5, Right"), or a float in a list, waits
+    that many seconds; bare digits are keys. 'delay' is a wait added after
+    each key.
+    '''
+    if isinstance(spec, (str, type(u""))):
+        spec = spec.split(",")
+
+    ops = []
+    for token in spec:
+        if isinstance(token, (str, type(u""))) and token.strip().lower().startswith("wait:"):
+            try:
+                token = float(token.strip()[len("wait:"):])
+            except ValueError:
+                raise ValueError("Invalid macro wait '{}'".format(token.strip()))
+
+        if isinstance(token, float):
+            ops.append(token)
+            continue
+
+        combo = token.split("+") if isinstance(token, (str, type(u""))) else [token]
+        hks = [kb_hid_code(kb_macro_key(key)) for key in combo]
+
+        ops.extend((hk, 1) for hk in hks)
+        ops.extend((hk, 0) for hk in reversed(hks))
+
+        if delay:
+            ops.append(float(delay))
+
+    state = kb_state()
+    steps = []
+    for op in ops:
+        if op.__class__ is float:
+            steps.append(op)
+        else:
+            if op[1]:
+                state.press(op[0])
+            else:
+                state.release(op[0])
+            steps.append(kb_report(state))
+
+    return Macro(name or str(spec), steps, ops)
 
 
 ## State Functions
 
+def kb_play(queue, macro, state=None):
+    '''Send a compiled macro, on top of the keys held in 'state' (if given)'''
+
+    if state is not None and any(state.report):
+        kb_play_overlay(queue, macro, state)
+        return
+
+    frames = isinstance(queue, FrameQueue)
+    for step in macro.steps:
+        if step.__class__ is float:
+            queue.pause(step)
+            continue
+
+        queue.put(step)
+
+        # Each macro report is its own frame
+        if frames:
+            queue.flush()
+
+
+def kb_play_overlay(queue, macro, state):
+    '''Send a macro with the keys held in 'state' kept held, then restore 'state' exactly
+
+    Keys the macro uses are released first, so that its presses reach the host.
+    '''
+
+    frames = isinstance(queue, FrameQueue)
+
+    overlay = kb_state()
+    overlay.report[:] = state.report
+    for hk in macro.keys:
+        overlay.release(hk)
+
+    last = kb_report(state)
+    for op in (None,) + macro.ops:
+        if op.__class__ is float:
+            queue.pause(op)
+            continue
+
+        if op is not None:
+            if op[1]:
+                overlay.press(op[0])
+            else:
+                overlay.release(op[0])
+
+        report = kb_report(overlay)
+        if report != last:
+            queue.put(report)
+            if frames:
+                queue.flush()
+            last = report
+
+    # Back to the real held keys
+    report = kb_report(state)
+    if report != last:
+        queue.put(report)
+        if frames:
+            queue.flush()
+
+
 def kb_sim_keypress(queue, *scancodes, **options):
-    if "state" in options:
-        state = options["state"]
-    else:
-        state = kb_state()
+    '''Press and release each key in turn, without disturbing keys held in options["state"]'''
+    kb_play(queue, kb_macro(list(scancodes)), options.get("state"))
+
+
+def cc_report(consumer):
+    '''Convert consumer state to a 16-bit consumer control report'''
+    if not consumer.held:
+        return CC_EMPTY_REPORT
+    return struct.pack(descriptors.CONSUMER_REPORT_FORMAT, consumer.held[-1])
 
-    for sc in scancodes:
-        kbh_basic(queue, state, SimKeyEvent(sc, 1))
-        kbh_basic(queue, state, SimKeyEvent(sc, 0))
+
+def mouse_reports(mouse):
+    '''Reports for a frame's buttons and motion, split to fit int8 fields'''
+
+    dx, dy, wheel = mouse.dx, mouse.dy, mouse.wheel
+    mouse.dx = mouse.dy = mouse.wheel = 0
+    mouse.changed = False
+
+    m = descriptors.MOUSE_AXIS_MAX
+    reports = []
+    while True:
+        sx = max(-m, min(m, dx))
+        sy = max(-m, min(m, dy))
+        sw = max(-m, min(m, wheel))
+        reports.append(
+            struct.pack(descriptors.MOUSE_REPORT_FORMAT, mouse.buttons, sx, sy, sw))
+
+        dx, dy, wheel = dx - sx, dy - sy, wheel - sw
+        if not (dx or dy or wheel):
+            return reports
 
 
 def kbh_basic(queue, state, data):
     '''Basic keyboard key press handler'''
 
-    hk = kb_hid_code(data.scancode)
+    consumer = state.consumer
+    if consumer is not None and data.code in CC_USAGE_TABLE:
+        # Media keys go to the TV natively, on the consumer control endpoint
+        usage = CC_USAGE_TABLE[data.code]
+        if data.value == 1:
+            consumer.press(usage)
+        elif data.value == 0:
+            consumer.release(usage)
+        else:
+            return
+        consumer.queue.put(cc_report(consumer))
+        return
 
-    if data.keystate == 1:
-        # Key down
-        if hk in KB_MOD_HID_MASK:
-            state["kb_mods"][hk] = KB_MOD_HID_MASK[hk]
+    hk = kb_hid_code(data.code)
 
-        state["kb_keys"].pop()
-        state["kb_keys"].insert(0, hk)
+    if AUTOREPEAT != "host" and not KB_MOD_TABLE[hk]:
+        kbh_tap(queue, state, data, hk)
+        return
 
-    elif data.keystate == 0:
-        # Key up
-        if hk in KB_MOD_HID_MASK:
-            state["kb_mods"][hk] = 0
+    if data.value == 1:
+        # Key down
+        state.press(hk)
 
-        if hk in state["kb_keys"]:
-            state["kb_keys"].pop(state["kb_keys"].index(hk))
-            state["kb_keys"].append(0)
+    elif data.value == 0:
+        # Key up
+        state.release(hk)
 
-    elif data.keystate == 2:
-        # Key held
-        pass
+    elif data.value == 2:
+        # Key held, and the host repeats it itself
+        return
 
-    #if data.keystate == 1:
+    #if data.value == 1:
     #    print(
     #        "Key: {}, Scan: {}, HID: {}, State: {}, Mods: 0x{:x}, Keys: {}".format(
-    #            kb_key_name(data.scancode, "???"), data.scancode, hk,
-    #            data.keystate, or_values(state["kb_mods"]), state["kb_keys"]
+    #            kb_key_name(data.code, "???"), data.code, hk,
+    #            data.value, state.report[0], list(state.report[2:])
     #        )
     #    )
 
     queue.put(kb_report(state))
 
 
+def kbh_tap(queue, state, data, hk):
+    '''Send a key as a tap, so the host never sees it held, repeating per AUTOREPEAT'''
+
+    if data.value == 1:
+        if AUTOREPEAT == "bridge":
+            state.repeat_times[data.code] = time.time() + AUTOREPEAT_DELAY
+
+    elif data.value == 2:
+        now = time.time()
+        if now < state.repeat_times.get(data.code, float("inf")):
+            return
+        state.repeat_times[data.code] = now + AUTOREPEAT_INTERVAL
+
+    else:
+        state.repeat_times.pop(data.code, None)
+        return
+
+    state.press(hk)
+    queue.put(kb_report(state))
+    state.release(hk)
+    queue.put(kb_report(state))
+
+
+def kbh_basic_key_codes(state):
+    '''EV_KEY codes kbh_basic can forward'''
+    key_codes = set(sc for sc, hk in enumerate(KB_HID_TABLE) if hk)
+    if state.consumer is not None:
+        key_codes.update(CC_USAGE_TABLE)
+    return key_codes
+
+
+# Handlers may list the EV_KEY codes they use, so the kernel can drop the rest
+kbh_basic.key_codes = kbh_basic_key_codes
+
+
 class WatchdogTimeout(RuntimeError):
     pass
 
@@ -160,52 +783,237 @@ class QuitInputMode(Exception):
     pass
 
 
+class KeyboardLayout(object):
+    '''On-screen keyboard: key positions and shortest arrow-key paths between cells'''
+
+    MOVES = ("up", "down", "left", "right")
+
+    def __init__(self, layout_map, keys, step):
+        self.rows = len(layout_map)
+        self.cols = max(len(row) for row in layout_map)
+
+        self._layout_map = layout_map
+        self._row_lengths = [len(row) for row in layout_map]
+        self._keys = keys
+        self._paths = self._shortest_paths(step)
+
+    def __contains__(self, layout_key):
+        return layout_key in self._keys
+
+    def __getitem__(self, layout_key):
+        return self._keys[layout_key]
+
+    def has_cell(self, x, y):
+        return 0 <= y < self.rows and 0 <= x < self._row_lengths[y]
+
+    def char(self, x, y):
+        '''Layout map character at (x,y)'''
+        return self._layout_map[y][x]
+
+    def path(self, x, y, tx, ty):
+        '''Fewest moves from (x,y) to (tx,ty) as [(move, (x, y)), ...], or None'''
+        return self._paths.get((x, y), {}).get((tx, ty))
+
+    def _shortest_paths(self, step):
+        cells = [(x, y) for y in xrange(self.rows) for x in xrange(self._row_lengths[y])]
+
+        # Edges: cell -> [(move, next cell)], as decided by the translator's step rule
+        edges = {}
+        for x, y in cells:
+            edges[(x, y)] = []
+            for move in self.MOVES:
+                dest = step(self, x, y, move)
+                if dest is not None and dest != (x, y) and self.has_cell(*dest):
+                    edges[(x, y)].append((move, dest))
+
+        # Breadth-first search from every cell
+        paths = {}
+        for src in cells:
+            found = {src: ()}
+            frontier = [src]
+            while frontier:
+                next_frontier = []
+                for cell in frontier:
+                    for move, dest in edges[cell]:
+                        if dest not in found:
+                            found[dest] = found[cell] + ((move, dest),)
+                            next_frontier.append(dest)
+                frontier = next_frontier
+            paths[src] = found
+
+        return paths
+
+
+class NavPacing(object):
+    '''Translator navigation delays, adapted to how fast the app keeps up
+
+    The TV gives no feedback, so delays shrink slowly while typing goes
+    uncorrected and grow quickly when the watchdog trips or the user
+    corrects a translated key. Learned delays are saved per app profile.
+    '''
+
+    # Successful keypresses between saves
+    SAVE_INTERVAL = 20
+
+    def __init__(self, profile, defaults, path=None):
+        self.profile = profile
+        self.path = PACING_PATH if path is None else path
+        self.delays = dict(defaults)
+
+        self._unsaved = 0
+
+        saved = self._read_all().get(profile, {})
+        for kind in self.delays:
+            if kind in saved:
+                self.delays[kind] = saved[kind]
+
+    def __getitem__(self, kind):
+        return self.delays[kind]
+
+    def success(self):
+        for kind, delay in self.delays.iteritems():
+            self.delays[kind] = max(PACING_MIN, delay * PACING_DECREASE)
+
+        self._unsaved += 1
+        if self._unsaved >= self.SAVE_INTERVAL:
+            self.save()
+
+    def backoff(self):
+        for kind, delay in self.delays.iteritems():
+            self.delays[kind] = min(PACING_MAX, delay * PACING_INCREASE)
+
+        print("Navigation delays for '{}' increased: {}".format(self.profile, self.delays))
+        self.save()
+
+    def _read_all(self):
+        if not self.path:
+            return {}
+        try:
+            with open(self.path) as fh:
+                return json.load(fh)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save(self):
+        self._unsaved = 0
+        if not self.path:
+            return
+
+        profiles = self._read_all()
+        profiles[self.profile] = self.delays
+        try:
+            with open(self.path, 'w') as fh:
+                json.dump(profiles, fh, indent=2, sort_keys=True, separators=(",", ": "))
+        except (IOError, OSError) as e:
+            print("Could not save navigation delays to '{}': {}".format(self.path, e))
+
+
 class InputTranslator(object):
     LAYOUT_SWAP = "<swap>"
 
+    # On-screen keyboard pages, must be assigned by derivative class
+    LAYOUT_MAP = None
+    LAYOUT_MAP_ALT = None
+
+    # Built layouts, per class
+    _layout_cache = {}
+
+    # Layout map character -> key name ("+" means shifted)
+    LAYOUT_CHARS = {
+        "a": LAYOUT_SWAP,
+        "b": "KEY_BACKSPACE",
+        "c": "KEY_DELETE",  # Clear all
+        "s": "KEY_SPACE",
+        "e": "KEY_ENTER",
+        "-": "KEY_MINUS",
+        "'": "KEY_APOSTROPHE",
+        "&": "+KEY_7",
+        "#": "+KEY_3",
+        "(": "+KEY_9",
+        ")": "+KEY_0",
+        "@": "+KEY_2",
+        "!": "+KEY_1",
+        "?": "+KEY_SLASH",
+        ":": "+KEY_SEMICOLON",
+        ".": "KEY_DOT",
+        "_": "+KEY_MINUS",
+        '"': "+KEY_APOSTROPHE",
+        '/': "KEY_SLASH",
+        ';': "KEY_SEMICOLON",
+        '*': "+KEY_8",
+        ',': "KEY_COMMA",
+        "%": "+KEY_5",
+        "$": "+KEY_4",
+        "+": "+KEY_EQUAL",
+    }
+
+    # Default navigation delays: after a move, after selecting a key, after a page swap
+    PACING = {
+        "move": 0.1,
+        "select": 0.4,
+        "swap": 0.4,
+    }
+
+    MOVE_KEYS = {
+        "up": codes.SCANCODES["KEY_UP"],
+        "down": codes.SCANCODES["KEY_DOWN"],
+        "left": codes.SCANCODES["KEY_LEFT"],
+        "right": codes.SCANCODES["KEY_RIGHT"],
+    }
+
+    MOVE_MACROS = dict((move, kb_macro([sc])) for move, sc in MOVE_KEYS.items())
+    SELECT_MACRO = kb_macro("Enter")
+
     @staticmethod
     def shift_layout_key(key):
         return "+{}".format(key)
 
+    @staticmethod
+    def layout_step(layout, x, y, move):
+        '''Cell reached by pressing 'move' at (x,y), or None if the move isn't allowed'''
+        if move == "up":
+            return x, y - 1
+        if move == "down":
+            return x, y + 1
+        if move == "left":
+            return x - 1, y
+        if move == "right":
+            return x + 1, y
+
     @classmethod
-    def create_layout(cls, layout_map):
-        char2keyname = {
-            "a": cls.LAYOUT_SWAP,
-            "b": "KEY_BACKSPACE",
-            "c": "KEY_DELETE",  # Clear all
-            "s": "KEY_SPACE",
-            "e": "KEY_ENTER",
-            "-": "KEY_MINUS",
-            "'": "KEY_APOSTROPHE",
-            "&": "+KEY_7",
-            "#": "+KEY_3",
-            "(": "+KEY_9",
-            ")": "+KEY_0",
-            "@": "+KEY_2",
-            "!": "+KEY_1",
-            "?": "+KEY_SLASH",
-            ":": "+KEY_SEMICOLON",
-            ".": "KEY_DOT",
-            "_": "+KEY_MINUS",
-            '"': "+KEY_APOSTROPHE",
-            '/': "KEY_SLASH",
-            ';': "KEY_SEMICOLON",
-            '*': "+KEY_8",
-            ',': "KEY_COMMA",
-            "%": "+KEY_5",
-            "$": "+KEY_4",
-            "+": "+KEY_EQUAL",
-        }
+    def layout_char_key(cls, ch):
+        '''Layout key for a layout map special character'''
+        keyname = cls.LAYOUT_CHARS[ch]
 
-        out = {
-            "rows": len(layout_map),
-            "cols": 0
-        }
+        if keyname.startswith("+"):
+            layout_key = cls.shift_layout_key(codes.SCANCODES.get(keyname[1:]))
+        else:
+            layout_key = codes.SCANCODES.get(keyname)
+
+        # If scancode doesn't exist, just use the key name as key
+        return layout_key or keyname
+
+    @classmethod
+    def text_layout_key(cls, ch):
+        '''Layout key that types text character 'ch', or None'''
+        if ch == " ":
+            return codes.SCANCODES["KEY_SPACE"]
+        if ch == "\n":
+            return codes.SCANCODES["KEY_ENTER"]
+        if re.match(r'[a-z0-9]', ch):
+            return codes.SCANCODES["KEY_{}".format(ch.upper())]
+        if re.match(r'[A-Z]', ch):
+            return cls.shift_layout_key(codes.SCANCODES["KEY_{}".format(ch)])
+        if ch in cls.LAYOUT_CHARS and not ch.isalpha():
+            return cls.layout_char_key(ch)
+        return None
+
+    @classmethod
+    def create_layout(cls, layout_map):
+        out = {}
 
         for y, row in enumerate(layout_map):
             for x, ch in enumerate(row):
-                out["cols"] = max(out["cols"], len(row))
-
                 pt = {
                     "x": x,
                     "y": y
@@ -213,16 +1021,8 @@ class InputTranslator(object):
                 if ch == " ":
                     # Unused button, ignore
                     pass
-                elif ch in char2keyname:
-                    keyname = char2keyname[ch]
-
-                    if keyname.startswith("+"):
-                        layout_key = cls.shift_layout_key(codes.SCANCODES.get(keyname[1:]))
-                    else:
-                        layout_key = codes.SCANCODES.get(keyname)
-
-                    # If scancode doesn't exist, just use char2keyname value as key
-                    out[layout_key or keyname] = pt
+                elif ch in cls.LAYOUT_CHARS:
+                    out[cls.layout_char_key(ch)] = pt
 
                 elif re.match(r'[A-Z0-9]', ch):
                     sc = codes.SCANCODES["KEY_{}".format(ch)]
@@ -234,14 +1034,26 @@ class InputTranslator(object):
                     print("Unknown layout char: {}".format(ch))
                     #raise RuntimeError("Unknown layout char: {}".format(ch))
 
-        return out
+        return KeyboardLayout(layout_map, out, cls.layout_step)
 
+    @classmethod
+    def layouts(cls):
+        '''(layout, alternate layout), built once per class'''
+        if cls not in cls._layout_cache:
+            cls._layout_cache[cls] = (
+                cls.create_layout(cls.LAYOUT_MAP),
+                cls.create_layout(cls.LAYOUT_MAP_ALT) if cls.LAYOUT_MAP_ALT else {},
+            )
+        return cls._layout_cache[cls]
 
-    def __init__(self, queue):
+
+    def __init__(self, queue, state=None):
         self.__watchdog = 0
 
-        self._layout = None  # Must be assigned by derivative class
-        self._layout_alt = {}
+        # Live keyboard state, kept held on the host while navigating
+        self._live = state
+
+        self._layout, self._layout_alt = self.layouts()
 
         self._quit_keys = [codes.SCANCODES[k] for k in
             ("KEY_UP", "KEY_DOWN", "KEY_LEFT", "KEY_RIGHT", "KEY_ESC")
@@ -251,156 +1063,308 @@ class InputTranslator(object):
         self._y = 0
         self._shift = False
 
-        self._delay = 0.1
+        self._pacing = NavPacing(type(self).__name__, self.PACING)
 
-        self.init(queue)
+        # Time of the last translated key not yet known to be good
+        self._last_typed = None
+
+        # Whether the on-screen cursor is known to be at (_x,_y)
+        self._synced = False
+
+        self.home(queue)
 
     def _increment_watchdog(self):
         self.__watchdog += 1
         if self.__watchdog > 40:
+            # Likely lost track of the cursor through dropped presses
+            self._pacing.backoff()
+            self._synced = False
             raise WatchdogTimeout(
                 "Watchdog expired after {} keypresses".format(self.__watchdog))
 
-        if (self._x < 0 or self._y < 0 or self._x >= self._layout["cols"]
-                or self._y >= self._layout["rows"]):
+        if (self._x < 0 or self._y < 0 or self._x >= self._layout.cols
+                or self._y >= self._layout.rows):
             raise RuntimeError(
                 "Position out of bounds: ({},{})".format(self._x, self._y))
 
     def _reset_watchdog(self):
         self.__watchdog = 0
 
-    def menu_delay(self, delay=-1):
+    def menu_delay(self, queue, delay=-1):
         if delay == -1:
-            delay = self._delay
+            delay = self._pacing["move"]
         if delay:
-            time.sleep(delay)
+            queue.pause(delay)
 
     def menu_up(self, queue, bump=False, delay=-1):
         self._increment_watchdog()
         if not bump:
             self._y -= 1
-        kb_sim_keypress(queue, codes.SCANCODES["KEY_UP"])
-        self.menu_delay()
+        kb_play(queue, self.MOVE_MACROS["up"], self._live)
+        self.menu_delay(queue)
 
     def menu_down(self, queue, bump=False, delay=-1):
         self._increment_watchdog()
         if not bump:
             self._y += 1
-        kb_sim_keypress(queue, codes.SCANCODES["KEY_DOWN"])
-        self.menu_delay()
+        kb_play(queue, self.MOVE_MACROS["down"], self._live)
+        self.menu_delay(queue)
 
     def menu_left(self, queue, bump=False, delay=-1):
         self._increment_watchdog()
         if not bump:
             self._x -= 1
-        kb_sim_keypress(queue, codes.SCANCODES["KEY_LEFT"])
-        self.menu_delay()
+        kb_play(queue, self.MOVE_MACROS["left"], self._live)
+        self.menu_delay(queue)
 
     def menu_right(self, queue, bump=False, delay=-1):
         self._increment_watchdog()
         if not bump:
             self._x += 1
-        kb_sim_keypress(queue, codes.SCANCODES["KEY_RIGHT"])
-        self.menu_delay()
+        kb_play(queue, self.MOVE_MACROS["right"], self._live)
+        self.menu_delay(queue)
+
+    def menu_move(self, queue, move, dest):
+        self._increment_watchdog()
+        self._x, self._y = dest
+        kb_play(queue, self.MOVE_MACROS[move], self._live)
+        self.menu_delay(queue)
 
     def menu_goto(self, queue, target):
         tx = target["x"]
         ty = target["y"]
 
-        # Move to row
-        while self._y < ty:
-            self.menu_down(queue)
-        while self._y > ty:
-            self.menu_up(queue)
+        path = self._layout.path(self._x, self._y, tx, ty)
+        if path is None:
+            raise RuntimeError("No path from ({},{}) to ({},{})".format(
+                self._x, self._y, tx, ty))
 
-        # Move to column
-        while self._x < tx:
-            self.menu_right(queue)
-        while self._x > tx:
-            self.menu_left(queue)
+        for move, dest in path:
+            self.menu_move(queue, move, dest)
 
-    def menu_select(self, queue, target=None):
+    def menu_select(self, queue, target=None, delay=-1):
         if target is not None:
             self.menu_goto(queue, target)
 
+        if delay == -1:
+            delay = self._pacing["select"]
+
         self._increment_watchdog()
-        self.menu_delay()
-        kb_sim_keypress(queue, codes.SCANCODES["KEY_ENTER"])
-        self.menu_delay(self._delay * 4)
+        self.menu_delay(queue)
+        kb_play(queue, self.SELECT_MACRO, self._live)
+        self.menu_delay(queue, delay)
+
+    def menu_swap(self, queue):
+        # Select keyboard swap key
+        self.menu_select(queue, self._layout[self.LAYOUT_SWAP], self._pacing["swap"])
+
+        # Swap layout maps
+        self._layout, self._layout_alt = self._layout_alt, self._layout
+
+    def plan_costs(self):
+        '''Planner cost of an arrow press, a key selection and a page swap, in seconds'''
+        move = self._pacing["move"]
+        return move, move + self._pacing["select"], move + self._pacing["swap"]
+
+    def plan_keys(self, layout_keys):
+        '''Cheapest way to select 'layout_keys' in order, across both layout pages
+
+        Returns [(swap_first, layout_key), ...]. Keys that are on neither
+        page are left out.
+        '''
+        move_cost, select_cost, swap_cost = self.plan_costs()
+        layouts = (self._layout, self._layout_alt)
+
+        def goto_cost(layout, x, y, target, select_cost=select_cost):
+            path = layout.path(x, y, target["x"], target["y"])
+            if path is None:
+                return None
+            return len(path) * move_cost + select_cost
+
+        # (page, x, y) -> cost so far, with one back-pointer table per key
+        costs = {(0, self._x, self._y): 0}
+        steps = []
+
+        for layout_key in layout_keys:
+            new_costs = {}
+            back = {}
+
+            for (page, x, y), cost in costs.iteritems():
+                for swap_first in (False, True):
+                    p, px, py, c = page, x, y, cost
+
+                    if swap_first:
+                        if self.LAYOUT_SWAP not in layouts[p]:
+                            continue
+                        swap = layouts[p][self.LAYOUT_SWAP]
+                        step_cost = goto_cost(layouts[p], px, py, swap, swap_cost)
+                        if step_cost is None:
+                            continue
+                        p, px, py, c = 1 - p, swap["x"], swap["y"], c + step_cost
+
+                    if layout_key not in layouts[p]:
+                        continue
+                    target = layouts[p][layout_key]
+                    step_cost = goto_cost(layouts[p], px, py, target)
+                    if step_cost is None:
+                        continue
+
+                    dest = (p, target["x"], target["y"])
+                    if dest not in new_costs or c + step_cost < new_costs[dest]:
+                        new_costs[dest] = c + step_cost
+                        back[dest] = ((page, x, y), swap_first)
+
+            if new_costs:
+                costs = new_costs
+                steps.append((layout_key, back))
+            else:
+                print("Ignoring key: {}".format(layout_key))
+
+        # Walk back from the cheapest end state
+        plan = []
+        node = min(costs, key=costs.get)
+        for layout_key, back in reversed(steps):
+            node, swap_first = back[node]
+            plan.append((swap_first, layout_key))
+        plan.reverse()
+
+        return plan
+
+    def type_keys(self, queue, layout_keys):
+        for swap_first, layout_key in self.plan_keys(layout_keys):
+            self._reset_watchdog()
+
+            if swap_first:
+                self.menu_swap(queue)
+
+            self.menu_select(queue, self._layout[layout_key])
+
+    def type_text(self, queue, text):
+        '''Type a whole string, planned as one sequence
+
+        Text after a newline is dropped, since searching moves the cursor.
+        Nothing calls this yet (input() types one key at a time through
+        type_keys()); it is meant for pasting whole search terms.
+        '''
+        text = text.split("\n", 1)[0]
+
+        layout_keys = []
+        for ch in text:
+            layout_key = self.text_layout_key(ch)
+            if layout_key is None:
+                print("Ignoring character: {!r}".format(ch))
+            else:
+                layout_keys.append(layout_key)
+
+        self.type_keys(queue, layout_keys)
+
+    def _corrects_last(self):
+        return (self._last_typed is not None
+            and time.time() - self._last_typed < PACING_CORRECTION_WINDOW)
 
     def init(self, queue):
+        '''Set the starting cursor position, moving the on-screen cursor there if needed'''
         pass
 
+    def home(self, queue):
+        self._layout, self._layout_alt = self.layouts()
+        self._shift = False
+        self._last_typed = None
+        self._synced = True
+
+        self.init(queue)
+
+    def resync(self, queue):
+        '''Re-enter this translator, only homing the cursor if its position was lost'''
+        self._shift = False
+        self._last_typed = None
+
+        if not self._synced:
+            self.home(queue)
+
+    def desync(self):
+        '''The on-screen cursor may have moved without this translator knowing'''
+        self._synced = False
+
     def input(self, queue, state, data):
-        if data.keystate == 0:
+        if data.value == 0:
             # Key-up
 
-            if (data.scancode == codes.SCANCODES["KEY_LEFTSHIFT"]
-                    or data.scancode == codes.SCANCODES["KEY_RIGHTSHIFT"]):
+            if (data.code == codes.SCANCODES["KEY_LEFTSHIFT"]
+                    or data.code == codes.SCANCODES["KEY_RIGHTSHIFT"]):
                 # Shift key is released
                 self._shift = False
 
-        elif data.keystate == 1:
+            if kb_held(state, data.code):
+                # Held since before the mode switch (kb_play keeps it held), so
+                # the host has to see it released
+                kbh_basic(queue, state, data)
+
+        elif data.value == 1:
             # Key-down
 
-            if (data.scancode == codes.SCANCODES["KEY_LEFTSHIFT"]
-                    or data.scancode == codes.SCANCODES["KEY_RIGHTSHIFT"]):
+            if (data.code == codes.SCANCODES["KEY_LEFTSHIFT"]
+                    or data.code == codes.SCANCODES["KEY_RIGHTSHIFT"]):
                 # Shift key is pressed
                 self._shift = True
 
-            elif data.scancode in self._quit_keys:
+            elif data.code in self._quit_keys:
                 # If any of these keys are used, then revert to default control
                 kbh_basic(queue, state, data)
                 raise QuitInputMode()
 
+            elif data.code == codes.SCANCODES["KEY_BACKSPACE"] and self._corrects_last():
+                # The user is fixing a translated key, so presses are likely being dropped
+                self._pacing.backoff()
+                self._last_typed = None
+                self.type_keys(queue, [data.code])
+
             else:
                 self._reset_watchdog()
 
+                # The previous key went uncorrected
+                if self._last_typed is not None:
+                    self._pacing.success()
+                self._last_typed = time.time()
+
                 if self._shift:
                     # Shift is pressed
-                    layout_key = self.shift_layout_key(data.scancode)
+                    layout_key = self.shift_layout_key(data.code)
                 else:
-                    layout_key = data.scancode
+                    layout_key = data.code
 
-                if (layout_key not in self._layout) and (layout_key in self._layout_alt):
-                    # Select keyboard swap key
-                    self.menu_select(queue, self._layout[self.LAYOUT_SWAP])
-
-                    # Swap layout maps
-                    self._layout, self._layout_alt = self._layout_alt, self._layout
-
-                if layout_key in self._layout:
-                    self.menu_select(queue, self._layout[layout_key])
+                if (layout_key in self._layout) or (layout_key in self._layout_alt):
+                    self.type_keys(queue, [layout_key])
 
                     # Searching will change x,y position, so just give up
-                    if data.scancode == codes.SCANCODES["KEY_ENTER"]:
+                    if data.code == codes.SCANCODES["KEY_ENTER"]:
                         raise QuitInputMode()
 
                 else:
                     # Key is not in layout
                     print("Ignoring key: {} ({})".format(
-                        layout_key, kb_key_name(data.scancode)))
+                        layout_key, kb_key_name(data.code)))
                     #kbh_basic(queue, state, data)
 
 
 class InputYoutube(InputTranslator):
 
-    def init(self, queue):
-        self._layout = self.create_layout([
-            "ABCDEFGb",
-            "HIJKLMNa",
-            "OPQRSTU",
-            "VWXYZ-'",
-            "sce",
-        ])
-
-        self._layout_alt = self.create_layout([
-            "123&#()b",
-            "456@!?:a",
-            '7890._"',
-            "sc ",
-        ])
+    LAYOUT_MAP = [
+        "ABCDEFGb",
+        "HIJKLMNa",
+        "OPQRSTU",
+        "VWXYZ-'",
+        "sce",
+    ]
+
+    LAYOUT_MAP_ALT = [
+        "123&#()b",
+        "456@!?:a",
+        '7890._"',
+        "sc ",
+    ]
 
+    def init(self, queue):
         self._x = 7
         self._y = 0
 
@@ -408,180 +1372,161 @@ class InputYoutube(InputTranslator):
             self.menu_up(queue, True)
             self.menu_right(queue, True)
 
-    def menu_goto(self, queue, target):
-        tx = target["x"]
-        ty = target["y"]
-
-        #def debug_print_xy():
-        #    print("({},{}) -> ({},{})".format(self._x, self._y, tx, ty))
-
-        last_row = self._layout["rows"] - 1
-        last_col = self._layout["cols"] - 1
+    @staticmethod
+    def layout_step(layout, x, y, move):
+        last_row = layout.rows - 1
 
-        # If going to or from bottom row, always move to left side first
-        if self._y != ty and (self._y == last_row or ty == last_row):
-            while self._x > 0:
-                self.menu_left(queue)
+        if move in ("up", "down"):
+            # Going to or from bottom row only works from the left side
+            ny = y - 1 if move == "up" else y + 1
+            if (y == last_row or ny == last_row) and x != 0:
+                return None
 
-        # If coming from the right-most column, always move left first
-        if self._x != tx and self._x == last_col:
-            self.menu_left(queue)
+        return InputTranslator.layout_step(layout, x, y, move)
 
-        # Move to row
-        while self._y < ty:
-            self.menu_down(queue)
-        while self._y > ty:
-            self.menu_up(queue)
+    def menu_goto(self, queue, target):
+        InputTranslator.menu_goto(self, queue, target)
 
-        # Add an extra movement for safety
+        # Add extra movements for safety
         if self._y == 0:
             self.menu_up(queue, True)
-
-        # Move to column
-        while self._x < tx:
-            self.menu_right(queue)
-        while self._x > tx:
-            self.menu_left(queue)
-
-        # Add an extra movement for safety
-        if self._x == last_col:
+        if self._x == self._layout.cols - 1:
             self.menu_right(queue, True)
 
 
 class InputHulu(InputTranslator):
 
-    def init(self, queue):
-        self._layout = self.create_layout([
-            "asABCDEFGHIJKLMNOPQRSTUVWXYZb"
-        ])
+    LAYOUT_MAP = [
+        "asABCDEFGHIJKLMNOPQRSTUVWXYZb"
+    ]
 
-        self._layout_alt = self.create_layout([
-            "as1234567890b"
-        ])
+    LAYOUT_MAP_ALT = [
+        "as1234567890b"
+    ]
 
+    def init(self, queue):
         self._x = 15
         self._y = 0
 
-    def menu_goto(self, queue, target):
-        tx = target["x"]
-
-        last_col = self._layout["cols"] - 1
-
-        is_target_left = tx < self._x
-        is_target_near = abs(tx - self._x) < (last_col + 1)*0.5
+    @staticmethod
+    def layout_step(layout, x, y, move):
+        # Single row that wraps around
+        if move == "left":
+            return (x - 1) % layout.cols, y
+        if move == "right":
+            return (x + 1) % layout.cols, y
+        return None
 
-        while self._x != tx:
-            if is_target_left != is_target_near:  # xor
-                self.menu_right(queue)
-            else:
-                self.menu_left(queue)
 
-            if self._x > last_col:
-                self._x = 0
-            if self._x < 0:
-                self._x = last_col
+class InputAmazonPrimeVideo(InputTranslator):
 
+    LAYOUT_MAP = [
+        "QWERTYUIOPb",
+        "ASDFGHJKLac",
+        "ZXCVBNM s  "
+    ]
 
-class InputAmazonPrimeVideo(InputTranslator):
+    LAYOUT_MAP_ALT = [
+        "1234567890b",
+        '-/:;()*&"ac',
+        ".,?!%$'@+# "
+    ]
 
     def init(self, queue):
-        self._layout = self.create_layout([
-            "QWERTYUIOPb",
-            "ASDFGHJKLac",
-            "ZXCVBNM s  "
-        ])
-
-        self._layout_alt = self.create_layout([
-            "1234567890b",
-            '-/:;()*&"ac',
-            ".,?!%$'@+# "
-        ])
-
         self._x = 0
         self._y = 0
 
-    def menu_goto(self, queue, target):
-        tx = target["x"]
-        ty = target["y"]
+    @staticmethod
+    def layout_step(layout, x, y, move):
+        # Cells covered by the long space bar
+        space_bar = (7, 9)
 
-        #def debug_print_xy():
-        #    print("({},{}) -> ({},{})".format(self._x, self._y, tx, ty))
+        if move == "down":
+            y += 1
 
-        last_row = self._layout["rows"] - 1
-        last_col = self._layout["cols"] - 1
+            # Landing on the long space bar shifts 1 to the left
+            if y == 2 and x in space_bar and layout.char(x, y) == " ":
+                x -= 1
 
-        # Move to row
-        while self._y < ty:
-            self.menu_down(queue)
+        elif move == "up":
+            y -= 1
 
-            # Account for long space bar (shift 1 to the left)
-            if self._y == 2 and (self._x == 7 or self._x == 9):
-                self._x -= 1
+        else:
+            dx = -1 if move == "left" else 1
+            x += dx
 
-        while self._y > ty:
-            self.menu_up(queue)
+            # Skip over the long space bar
+            if y == 2 and x in space_bar and layout.char(x, y) == " ":
+                x += dx
 
-        # Move to column (wraps)
-        is_target_left = tx < self._x
-        is_target_near = abs(tx - self._x) < (last_col + 1)*0.5
+            # Columns wrap around
+            x %= layout.cols
 
-        while self._x != tx:
-            if is_target_left != is_target_near:  # xor
-                self.menu_right(queue)
+        return x, y
 
-                # Account for long space bar
-                if self._y == 2 and (self._x == 7 or self._x == 9):
-                    self._x += 1
-            else:
-                self.menu_left(queue)
 
-                # Account for long space bar
-                if self._y == 2 and (self._x == 7 or self._x == 9):
-                    self._x -= 1
 
-            if self._x > last_col:
-                self._x = 0
-            if self._x < 0:
-                self._x = last_col
+def kb_set_translator(queue, state, cls):
+    '''Switch input translation mode, reusing translator instances'''
 
+    if state.input_translation is not None and queue.busy:
+        # Navigation is about to be dropped, so the cursor position is lost
+        state.input_translation.desync()
 
+    # Abandon navigation still scheduled by the previous mode, leaving the
+    # keys that are physically held down on the host
+    queue.cancel(kb_report(state))
 
-def kbh_tv_menu(queue, state, data):
+    if cls is None:
+        state.input_translation = None
+        return
 
-    if data.scancode == codes.SCANCODES["KEY_VOLUMEUP"]:
-        if (data.keystate == 1):
-            state["input_translation"] = None
-            print("Input mode: Default")
+    translator = state.translators.get(cls)
+    if translator is None:
+        translator = state.translators[cls] = cls(queue, state)
+    else:
+        translator.resync(queue)
+
+    state.input_translation = translator
 
-    elif data.scancode == codes.SCANCODES["KEY_VOLUMEDOWN"]:
-        if (data.keystate == 1):
-            state["input_translation"] = InputYoutube(queue)
-            print("Input mode: Youtube")
 
-    elif data.scancode == codes.SCANCODES["KEY_MUTE"]:
-        if (data.keystate == 1):
-            state["input_translation"] = InputHulu(queue)
-            print("Input mode: Hulu")
+# Mode switch keys: scancode -> (translator class, mode name)
+TV_MENU_MODES = {
+    codes.SCANCODES["KEY_VOLUMEUP"]: (None, "Default"),
+    codes.SCANCODES["KEY_VOLUMEDOWN"]: (InputYoutube, "Youtube"),
+    codes.SCANCODES["KEY_MUTE"]: (InputHulu, "Hulu"),
+    codes.SCANCODES["KEY_NEXTSONG"]: (InputAmazonPrimeVideo, "AmazonPrimeVideo"),
+}
 
-    elif data.scancode == codes.SCANCODES["KEY_NEXTSONG"]:
-        if (data.keystate == 1):
-            state["input_translation"] = InputAmazonPrimeVideo(queue)
-            print("Input mode: AmazonPrimeVideo")
+
+def kbh_tv_menu(queue, state, data):
+
+    mode = TV_MENU_MODES.get(data.code)
+    if mode is not None:
+        if (data.value == 1):
+            kb_set_translator(queue, state, mode[0])
+            print("Input mode: {}".format(mode[1]))
 
     else:
 
-        if state["input_translation"] is None:
+        if state.input_translation is None:
             kbh_basic(queue, state, data)
 
+            # Keys sent to the TV may move any on-screen keyboard cursor
+            if data.value == 1:
+                for translator in state.translators.itervalues():
+                    translator.desync()
+
         else:
             try:
-                state["input_translation"].input(queue, state, data)
+                state.input_translation.input(queue, state, data)
             except QuitInputMode:
-                state["input_translation"] = None
+                state.input_translation.desync()
+                state.input_translation = None
 
-    #hk = kb_hid_code(data.scancode)
+    #hk = kb_hid_code(data.code)
 
-    #if data.keystate == 1 and hk == 69:
+    #if data.value == 1 and hk == 69:
     #    # Press arrow keys in a circle
     #    kb_sim_keypress(queue, 108, 106, 103, 105)
 
@@ -589,94 +1534,1382 @@ def kbh_tv_menu(queue, state, data):
     #    kbh_basic(queue, state, data)
 
 
+def kbh_tv_menu_key_codes(state):
+    '''EV_KEY codes kbh_tv_menu uses (translators only read keys kbh_basic knows)'''
+    return kbh_basic_key_codes(state) | set(TV_MENU_MODES)
+
+
+kbh_tv_menu.key_codes = kbh_tv_menu_key_codes
+
+
 ## System Functions
 
-def dev_read_loop(devpath):
-    '''Wrapper for evdev.InputDevice.read_loop() to handle disconnects'''
+def ev_set_mask(fd, event_type, event_codes):
+    '''Have the kernel deliver only 'event_codes' of 'event_type' to this fd
+
+    For event type 0 (EV_SYN), the codes are the event types to deliver.
+    EV_SYN events themselves are always delivered.
+    '''
+    bits = bytearray((EV_CODE_COUNTS[event_type] + 7) // 8)
+    for code in event_codes:
+        bits[code >> 3] |= 1 << (code & 7)
+
+    buf = ctypes.create_string_buffer(bytes(bits), len(bits))
+    fcntl.ioctl(fd, EVIOCSMASK,
+        struct.pack("IIQ", event_type, len(bits), ctypes.addressof(buf)))
+
+
+class Histogram(object):
+    '''Log-linear histogram of microsecond values, in the style of HdrHistogram
+
+    Values below 32 have exact buckets, larger ones 16 buckets per power of
+    two, so any recorded value is within about 6% of its bucket.
+    '''
 
-    # Get keyboard device
-    print("Waiting for device '{}'...".format(devpath))
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * 64
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    @staticmethod
+    def bucket(value):
+        if value < 32:
+            return value
+        shift = value.bit_length() - 5
+        return 16 + 16 * shift + (value >> shift)
+
+    @staticmethod
+    def bucket_value(i):
+        '''Highest value that falls in bucket i'''
+        if i < 32:
+            return i
+        shift = (i - 16) // 16 - 1
+        return ((i - 16 - 16 * shift + 1) << shift) - 1
+
+    def record(self, seconds):
+        value = max(0, int(seconds * 1e6))
+        i = self.bucket(value)
+        if i >= len(self.counts):
+            self.counts.extend([0] * (i + 1 - len(self.counts)))
+        self.counts[i] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        '''Value (in microseconds) at or below which p percent of values fall'''
+        if not self.count:
+            return 0
+        target = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= target:
+                return min(self.bucket_value(i), self.max)
+        return self.max
+
+
+class TracedReport(bytes):
+    '''Report bytes tagged with when its input event happened and when it was queued'''
+
+
+class LatencyTracer(object):
+    '''Latency histograms for each stage from evdev event to gadget write
+
+    input:   evdev event timestamp -> read by the bridge
+    handler: time spent in the handler chain for a key event
+    queue:   report queued -> write started
+    write:   the write() syscall
+    total:   evdev event timestamp -> write finished
+    '''
+
+    STAGES = ("input", "handler", "queue", "write", "total")
+
+    def __init__(self):
+        self.histograms = dict((stage, Histogram()) for stage in self.STAGES)
+
+        # Timestamp of the latest input event, for reports it causes
+        self.origin = None
+
+    def event(self, event, now):
+        self.origin = event.sec + event.usec * 1e-6
+        self.histograms["input"].record(now - self.origin)
+
+    def handled(self, start, end):
+        self.histograms["handler"].record(end - start)
+
+    def tag(self, report):
+        if type(report) is TracedReport:
+            return report
+        report = TracedReport(report)
+        report.origin = self.origin
+        report.queued = time.time()
+        return report
+
+    def written(self, report, start, end):
+        if type(report) is not TracedReport:
+            return
+        self.histograms["queue"].record(start - report.queued)
+        self.histograms["write"].record(end - start)
+        if report.origin is not None:
+            self.histograms["total"].record(end - report.origin)
+
+    def dump(self, out=None):
+        out = out or sys.stderr
+        print("{:<8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}".format(
+            "us", "count", "mean", "p50", "p90", "p99", "max"), file=out)
+        for stage in self.STAGES:
+            h = self.histograms[stage]
+            print("{:<8} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}".format(
+                stage, h.count, h.total // h.count if h.count else 0,
+                h.percentile(50), h.percentile(90), h.percentile(99), h.max), file=out)
+
+
+class EventLoop(object):
+    '''Single-threaded select() loop with fd readers, fd writers and timers'''
+
+    def __init__(self):
+        self._readers = {}
+        self._writers = {}
+        self._timers = []
+        self._timer_seq = itertools.count()
+        self._running = False
+
+    @staticmethod
+    def time():
+        return time.time()
 
-    dev = None
-    while dev is None:
+    def add_reader(self, fd, callback):
+        self._readers[fd] = callback
+
+    def remove_reader(self, fd):
+        self._readers.pop(fd, None)
+
+    def add_writer(self, fd, callback):
+        self._writers[fd] = callback
+
+    def remove_writer(self, fd):
+        self._writers.pop(fd, None)
+
+    def call_later(self, delay, callback, *args):
+        '''Run callback(*args) after 'delay' seconds. Returns a handle for cancel().'''
+        timer = [self.time() + delay, next(self._timer_seq), callback, args]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    @staticmethod
+    def cancel(timer):
+        timer[2] = None
+
+    def stop(self):
+        self._running = False
+
+    def _select(self, readers, writers, timeout):
         try:
-            dev = evdev.InputDevice(devpath)
-            print("Connected to '{}'.".format(devpath))
-        except:
-            time.sleep(1)
+            return select.select(readers, writers, [], timeout)[:2]
+        except (select.error, IOError, OSError) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return [], []
+
+    def _run_timers(self):
+        now = self.time()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, callback, args = heapq.heappop(self._timers)
+            if callback is not None:
+                callback(*args)
+
+    def _timeout(self):
+        while self._timers and self._timers[0][2] is None:
+            heapq.heappop(self._timers)
+        if not self._timers:
+            return None
+        return max(0, self._timers[0][0] - self.time())
+
+    def run(self):
+        self._running = True
+        while self._running:
+            r, w = self._select(list(self._readers), list(self._writers), self._timeout())
+
+            for fd in w:
+                callback = self._writers.get(fd)
+                if callback is not None:
+                    callback()
+
+            for fd in r:
+                callback = self._readers.get(fd)
+                if callback is not None:
+                    callback()
+
+            self._run_timers()
+
+
+class Inotify(object):
+    '''Minimal Linux inotify wrapper, readable from the event loop'''
+
+    IN_ATTRIB = 0x004
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        self._watches = {}
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, path.encode("utf-8")
+            if not isinstance(path, bytes) else path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+
+        self._watches[wd] = path
+        return wd
+
+    def read(self):
+        '''Pending events as [(watched path, name, mask), ...]'''
+        try:
+            buf = os.read(self.fd, 4096)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+
+        events = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, length = self._EVENT.unpack_from(buf, offset)
+            offset += self._EVENT.size
+            name = buf[offset:offset + length].rstrip(b"\0").decode("utf-8")
+            offset += length
+            events.append((self._watches.get(wd), name, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class InputReader(object):
+    '''Reads one grabbed evdev device from the event loop and feeds the handler chain'''
+
+    def __init__(self, loop, dev, queue, state, handler, on_close, coalesce=COALESCE_FRAMES,
+            on_first_key=None, mouse=None, mouse_queue=None):
+        self.dev = dev
+        self.devpath = dev.path
+        self.identity = DeviceManager.identity(dev)
+
+        # Scancodes currently held down on this device
+        self.held = set()
+
+        self._loop = loop
+        self._queue = queue
+        self._state = state
+        self._mouse = mouse
+        self._mouse_queue = mouse_queue
+        self._handler = handler
+        self._on_close = on_close
+        self._on_first_key = on_first_key
+        self._coalesce = coalesce
+
+        self._loop.add_reader(dev.fd, self._read)
+
+    def close(self):
+        if self.dev is None:
+            return
+
+        self._loop.remove_reader(self.dev.fd)
+        try:
+            self.dev.close()
+        except (IOError, OSError):
+            pass
+        self.dev = None
 
-    # Reserve exclusive access
-    dev.grab()
+        # Release keys still held on this device, so they don't stick on the host
+        self._release_held()
+        self._end_frame()
 
-    # Wrap read_loop()
-    it = dev.read_loop()
-    while True:
+        self._on_close(self)
+
+    def _release_held(self):
+        held = sorted(self.held)
+        self.held.clear()
+
+        # Handlers update their own state (e.g. remapped keys and layers)...
+        for scancode in held:
+            if MOUSE_BUTTON_MIN <= scancode <= MOUSE_BUTTON_MAX:
+                self._mouse.button(scancode, 0)
+            else:
+                self._handle(SimKeyEvent(scancode, 0))
+
+        # ...but may swallow key-ups (translators do), so release the keys in
+        # the keyboard state directly too
+        state = self._state
+        consumer = state.consumer
+        report = kb_report(state)
+        for scancode in held:
+            if consumer is not None and scancode in CC_USAGE_TABLE:
+                if CC_USAGE_TABLE[scancode] in consumer.held:
+                    consumer.release(CC_USAGE_TABLE[scancode])
+                    consumer.queue.put(cc_report(consumer))
+            elif scancode < len(KB_HID_TABLE) and KB_HID_TABLE[scancode]:
+                state.release(KB_HID_TABLE[scancode])
+
+        if kb_report(state) != report:
+            self._queue.put(kb_report(state))
+
+    def _read(self):
         try:
-            yield it.next()
-        except StopIteration:
-            break
-        except IOError as e:
+            events = list(self.dev.read())
+        except (IOError, OSError) as e:
+            if e.errno == errno.EAGAIN:
+                return
+
             # Device was disconnected
-            print("Input device '{}' was closed: {}".format(devpath, e))
-            break
+            print("Input device '{}' was closed: {}".format(self.dev.path, e))
+            self.close()
+            return
+
+        for event in events:
+            self._dispatch(event)
+
+    def _dispatch(self, event):
+        if event.type == EV_SYN:
+            if event.code == SYN_REPORT:
+                self._end_frame()
+
+        elif event.type == EV_REL:
+            if self._mouse is not None:
+                if TRACER is not None:
+                    TRACER.event(event, time.time())
+                self._mouse.move(event.code, event.value)
+
+        elif event.type == EV_KEY:
+            is_mouse = MOUSE_BUTTON_MIN <= event.code <= MOUSE_BUTTON_MAX
+            if is_mouse and self._mouse is None:
+                return
+
+            if event.value == 1:
+                self.held.add(event.code)
+
+                if self._on_first_key is not None:
+                    self._on_first_key(self)
+                    self._on_first_key = None
+
+            elif event.value == 0:
+                self.held.discard(event.code)
+
+            # Handlers get the raw event and only read its code and value
+            if TRACER is None:
+                if is_mouse:
+                    self._mouse.button(event.code, event.value)
+                else:
+                    self._handle(event)
+                return
 
+            t0 = time.time()
+            TRACER.event(event, t0)
+            if is_mouse:
+                self._mouse.button(event.code, event.value)
+            else:
+                self._handle(event)
+            TRACER.handled(t0, time.time())
 
-def loop_read_input_device(queue, devpath, handler):
-    while True:
-        state = kb_state()
+    def _end_frame(self):
+        if self._coalesce:
+            self._queue.flush()
 
-        for event in dev_read_loop(devpath):
-            if event.type == evdev.ecodes.EV_KEY:
-                data = evdev.categorize(event)
+        if self._mouse is not None and self._mouse.changed:
+            for report in mouse_reports(self._mouse):
+                self._mouse_queue.put(report)
 
-                try:
-                    handler(queue, state, data)
-                except Exception as e:
-                    print("Error in handler '{}': {}".format(handler.__name__, e))
+    def _handle(self, data):
+        try:
+            self._handler(self._queue, self._state, data)
+        except Exception as e:
+            print("Error in handler '{}': {}".format(self._handler.__name__, e))
 
-                    if HALT_ON_ERROR:
-                        queue.put(None)
-                        raise
-                    else:
-                        eprint(traceback.format_exc())
+            if HALT_ON_ERROR:
+                raise
+            else:
+                eprint(traceback.format_exc())
+
+
+class DeviceManager(object):
+    '''Opens every matching input device and follows hotplug in the input directory
+
+    All devices share one keyboard state and feed the same handler chain.
+    Mouse motion and buttons go to 'mouse_queue', and media keys handled by
+    kbh_basic to 'consumer_queue', if given.
+    '''
+
+    def __init__(self, loop, queue, handler, rules=None, devdir=INPUT_DEVICE_DIR,
+            coalesce=COALESCE_FRAMES, mouse_queue=None, consumer_queue=None):
+        self._loop = loop
+        self._handler = handler
+        self._rules = INPUT_DEVICE_RULES if rules is None else rules
+        self._devdir = devdir
+        self._coalesce = coalesce
+
+        self._queue = FrameQueue(queue) if coalesce else queue
+        self._state = kb_state()
+        if consumer_queue is not None:
+            self._state.consumer = ConsumerState(consumer_queue)
+        self._mouse = MouseState() if mouse_queue is not None else None
+        self._mouse_queue = mouse_queue
+        self._readers = {}
+        self._ignored = set()
+        self._inotify = None
+        self._event_mask = self.event_mask()
+
+        # Device identity -> time it disconnected, until its first key after reconnecting
+        self._disconnect_times = {}
+
+        # Seconds from a disconnect to the first key forwarded after reconnecting
+        self.reconnect_latencies = collections.deque(maxlen=100)
+
+    def start(self):
+        try:
+            self._inotify = Inotify()
+            self._inotify.add_watch(self._devdir, Inotify.IN_CREATE | Inotify.IN_ATTRIB
+                | Inotify.IN_MOVED_TO | Inotify.IN_DELETE)
+        except (AttributeError, OSError) as e:
+            print("Hotplug notifications unavailable, polling '{}': {}".format(self._devdir, e))
+            self._inotify = None
+        else:
+            self._loop.add_reader(self._inotify.fileno(), self._on_inotify)
 
+        print("Waiting for input devices in '{}'...".format(self._devdir))
+        self._scan()
 
-def loop_write_usb_hid(queue, devpath):
-    while True:
-        report = queue.get()
+    def _scan(self):
+        try:
+            names = sorted(os.listdir(self._devdir))
+        except OSError:
+            names = []
+
+        for name in names:
+            if name.startswith("event"):
+                self._open(os.path.join(self._devdir, name))
+
+        if self._inotify is None:
+            self._loop.call_later(DEVICE_RESCAN_INTERVAL, self._scan)
+
+    def _on_inotify(self):
+        for _, name, mask in self._inotify.read():
+            if not name.startswith("event"):
+                continue
+
+            devpath = os.path.join(self._devdir, name)
+            if mask & Inotify.IN_DELETE:
+                self._ignored.discard(devpath)
+                reader = self._readers.get(devpath)
+                if reader is not None:
+                    print("Input device '{}' was removed.".format(devpath))
+                    reader.close()
+            else:
+                self._open(devpath)
 
-        if report is None:
-            print("Received 'None' in queue. Exiting thread.")
-            break
+    @staticmethod
+    def identity(dev):
+        return dev.uniq or dev.phys or dev.name
+
+    def stats(self):
+        latencies = self.reconnect_latencies
+        return {
+            "devices": sorted(self._readers),
+            "reconnects": len(latencies),
+            "reconnect_latency_last": latencies[-1] if latencies else None,
+            "reconnect_latency_max": max(latencies) if latencies else None,
+        }
+
+    def matches(self, dev):
+        '''True if some rule's regexes all match the device's name/phys/uniq/path'''
+        if evdev.ecodes.EV_KEY not in dev.capabilities():
+            return False
+
+        for rule in self._rules:
+            if all(re.search(pattern, getattr(dev, field, None) or "")
+                    for field, pattern in rule.iteritems()):
+                return True
+        return False
+
+    def _open(self, devpath):
+        if devpath in self._readers or devpath in self._ignored:
+            return
+
+        try:
+            dev = evdev.InputDevice(devpath)
+        except (IOError, OSError):
+            # Not ready yet; permission changes arrive as IN_ATTRIB
+            return
+
+        if not self.matches(dev):
+            self._ignored.add(devpath)
+            dev.close()
+            return
+
+        try:
+            # Reserve exclusive access
+            dev.grab()
+        except (IOError, OSError) as e:
+            print("Could not grab input device '{}': {}".format(devpath, e))
+            dev.close()
+            return
+
+        print("Connected to '{}' ({}).".format(devpath, dev.name))
+        self._set_event_mask(dev)
+
+        on_first_key = None
+        if self.identity(dev) in self._disconnect_times:
+            on_first_key = self._on_reconnect_key
+
+        self._readers[devpath] = InputReader(self._loop, dev, self._queue, self._state,
+            self._handler, self._on_close, self._coalesce, on_first_key,
+            self._mouse, self._mouse_queue)
+
+    def event_mask(self):
+        '''{event type: codes to receive, or None for all}, for the handler chain'''
+        mask = {EV_KEY: None}
+
+        key_codes = getattr(self._handler, "key_codes", None)
+        if key_codes is not None:
+            mask[EV_KEY] = key_codes(self._state)
+
+        if self._mouse is not None:
+            mask[EV_REL] = None
+            if mask[EV_KEY] is not None:
+                mask[EV_KEY] = set(mask[EV_KEY])
+                mask[EV_KEY].update(xrange(MOUSE_BUTTON_MIN, MOUSE_BUTTON_MAX + 1))
+
+        return mask
+
+    def update_event_mask(self):
+        '''Refilter all devices, after the handler chain's needs changed'''
+        self._event_mask = self.event_mask()
+        for reader in list(self._readers.values()):
+            self._set_event_mask(reader.dev)
+
+    def _set_event_mask(self, dev):
+        try:
+            ev_set_mask(dev.fileno(), EV_SYN, self._event_mask)
+            for event_type, event_codes in self._event_mask.items():
+                if event_codes is None:
+                    event_codes = xrange(EV_CODE_COUNTS[event_type])
+                ev_set_mask(dev.fileno(), event_type, event_codes)
+        except (IOError, OSError) as e:
+            # Kernels before 4.4 can't filter, so every event is read
+            print("Could not filter events of '{}': {}".format(dev.path, e))
+
+    def _on_close(self, reader):
+        del self._readers[reader.devpath]
+        self._disconnect_times[reader.identity] = self._loop.time()
+
+    def _on_reconnect_key(self, reader):
+        disconnect_time = self._disconnect_times.pop(reader.identity, None)
+        if disconnect_time is None:
+            return
+
+        latency = self._loop.time() - disconnect_time
+        self.reconnect_latencies.append(latency)
+        print("First key from '{}' {:.3f}s after disconnect.".format(reader.identity, latency))
+
+
+class KeymapHandler(object):
+    '''Remaps keys through a keymap file (see keymap.py), then passes them to 'handler'
+
+    The file is recompiled whenever it changes. If it is missing or invalid,
+    the previous keymap stays in use (at first, keys pass through unchanged).
+    '''
+
+    def __init__(self, loop, path, handler):
+        self.path = path
+        self.keymap = keymap.compile_keymap({})
+        self.macros = []
+
+        # Called after the keymap is reloaded
+        self.on_reload = None
+        self.__name__ = "keymap:{}".format(handler.__name__)
+
+        self._loop = loop
+        self._handler = handler
+
+        # Active layers, most recent last
+        self._layers = [0]
+
+        # Physical scancode -> action applied when it was pressed
+        self._pressed = {}
+
+        # (kind, scancode, time) of a key waiting for a chord partner (kind
+        # None) or for its tap/hold to be decided (kind keymap.TAP_HOLD)
+        self._pending = None
+        self._timer = None
+
+        # (scancode, value) of events held back while a tap/hold key is
+        # undecided, replayed in order once it is
+        self._buffered = []
+
+        # (queue, state) of the last event, for keys resolved by timeout
+        self._sink = None
+
+        self.reload()
+
+        try:
+            self._inotify = Inotify()
+            self._inotify.add_watch(os.path.dirname(os.path.abspath(path)),
+                Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO)
+        except OSError as e:
+            print("Keymap changes will not be picked up: {}".format(e))
+        else:
+            loop.add_reader(self._inotify.fileno(), self._on_inotify)
+
+    def reload(self):
+        try:
+            km = keymap.load(self.path)
+            macros = [kb_macro(spec, name=name) for name, spec in km.macros]
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                print("Could not read keymap '{}': {}".format(self.path, e))
+            return
+        except ImportError as e:
+            # YAML keymap without PyYAML
+            print("Could not read keymap '{}': {}".format(self.path, e))
+            return
+        except (ValueError, NoHidCodeError) as e:
+            print("Invalid keymap '{}': {}".format(self.path, e))
+            return
+
+        if self._pending is not None and self._sink is not None:
+            self._resolve(*self._sink)
+
+        self.keymap = km
+        self.macros = macros
+        self._layers = [0]
+        print("Loaded keymap '{}' (layers: {}).".format(self.path, ", ".join(km.layer_names)))
+
+        if self.on_reload is not None:
+            self.on_reload()
+
+    def key_codes(self, state):
+        '''EV_KEY codes the keymap or the handler behind it uses, or None for all'''
+        inner_codes = getattr(self._handler, "key_codes", None)
+        if inner_codes is None:
+            return None
+        inner_codes = inner_codes(state)
+
+        km = self.keymap
+        used = set(code for code, chords in enumerate(km.chords) if chords)
+        for table in km.tables:
+            for code, action in enumerate(table):
+                if action[0] != keymap.KEY or action[1] != code or code in inner_codes:
+                    used.add(code)
+        return used
+
+    def _on_inotify(self):
+        name = os.path.basename(self.path)
+        if any(n == name for _, n, _ in self._inotify.read()):
+            self.reload()
+
+    def __call__(self, queue, state, data):
+        self._sink = (queue, state)
+        code = data.code
+        pending = self._pending
+
+        if data.value == 1 and pending is not None and pending[0] is None:
+            if code in self.keymap.chords[pending[1]]:
+                self._cancel_pending()
+                self._apply(queue, state, pending[1],
+                    self.keymap.chords[pending[1]][code])
+                self._pressed[code] = keymap.NO_ACTION
+                return
+
+            # No chord, so the pending key is pressed on its own
+            self._resolve(queue, state)
+            pending = self._pending
+
+        if pending is not None and pending[0] == keymap.TAP_HOLD and code != pending[1]:
+            # Hold other keys back until the tap/hold key is decided, so keys
+            # rolled over a tap still come after it
+            if data.value != 2:
+                self._buffered.append((code, data.value))
+            if data.value == 0 and (code, 1) in self._buffered:
+                # Another key pressed and released meanwhile means it is held
+                self._resolve(queue, state)
+            return
+
+        if data.value == 1:
+            self._press(queue, state, code, True)
+
+        elif data.value == 0:
+            while self._pending is not None and self._pending[1] == code:
+                self._resolve(queue, state, tap=True)
+
+            action = self._pressed.pop(code, None)
+            if action is None:
+                return
+
+            if action[0] == keymap.KEY:
+                self._emit(queue, state, action[1], 0)
+            elif action[0] == keymap.LAYER and action[1] in self._layers:
+                self._layers.remove(action[1])
+
+        else:
+            action = self._pressed.get(code)
+            if action is not None and action[0] == keymap.KEY:
+                self._emit(queue, state, action[1], data.value)
+
+    def _press(self, queue, state, code, chords):
+        km = self.keymap
+
+        if chords and km.chords[code] is not None:
+            self._set_pending(None, code, km.chord_time)
+            return
+
+        action = km.tables[self._layers[-1]][code]
+        if action[0] == keymap.TAP_HOLD:
+            self._set_pending(keymap.TAP_HOLD, code, km.hold_time)
+            return
+
+        self._apply(queue, state, code, action)
+
+    def _apply(self, queue, state, code, action):
+        self._pressed[code] = action
+
+        if action[0] == keymap.KEY:
+            self._emit(queue, state, action[1], 1)
+        elif action[0] == keymap.LAYER:
+            self._layers.append(action[1])
+        elif action[0] == keymap.MACRO:
+            kb_play(queue, self.macros[action[1]], state)
+
+    def _emit(self, queue, state, code, value):
+        self._handler(queue, state, SimKeyEvent(code, value))
+
+    def _set_pending(self, kind, code, timeout):
+        self._pending = (kind, code, self._loop.time())
+        self._timer = self._loop.call_later(timeout, self._on_timeout)
+
+    def _cancel_pending(self):
+        self._pending = None
+        if self._timer is not None:
+            self._loop.cancel(self._timer)
+            self._timer = None
+
+    def _resolve(self, queue, state, tap=False):
+        '''Decide the pending key: a tap if released in time, otherwise held
+
+        Events held back meanwhile are then replayed.
+        '''
+        kind, code, pressed = self._pending
+        self._cancel_pending()
+
+        if kind is None:
+            # No chord, so it's a normal key press (which may still be a tap/hold)
+            self._press(queue, state, code, False)
+            return
+
+        action = self.keymap.tables[self._layers[-1]][code]
+        if action[0] != keymap.TAP_HOLD:
+            # Reloaded meanwhile
+            self._apply(queue, state, code, action)
+        elif tap and self._loop.time() - pressed < self.keymap.hold_time:
+            self._apply(queue, state, code, action[1])
+        else:
+            self._apply(queue, state, code, action[2])
+
+        buffered, self._buffered = self._buffered, []
+        for code, value in buffered:
+            self(queue, state, SimKeyEvent(code, value))
+
+    def _on_timeout(self):
+        self._timer = None
+        queue, state = self._sink
+        self._resolve(queue, state)
+
+        if isinstance(queue, FrameQueue):
+            queue.flush()
+
+
+class HidWriter(object):
+    '''Long-lived writer for a HID gadget device node'''
 
+    def __init__(self, devpath, nonblock=False, backoff_min=0.05, backoff_max=2.0,
+            suppress_identical=True):
+        self.devpath = devpath
+        self.nonblock = nonblock
+
+        # Skip reports identical to the last one written. Must be off for
+        # reports that carry relative values, like mouse motion.
+        self.suppress_identical = suppress_identical
+
+        self._fd = None
+        self._last = None
+        self._backoff_min = backoff_min
+        self._backoff_max = backoff_max
+        self._backoff = 0
+        self._retry_time = 0
+
+        # Counters
+        self.writes = 0
+        self.dropped = 0
+        self.opens = 0
+        self.suppressed = 0
+        self.write_time_total = 0.0
+        self.write_time_max = 0.0
+
+    def _open(self):
+        now = time.time()
+        if now < self._retry_time:
+            return False
+
+        try:
+            flags = os.O_WRONLY
+            if self.nonblock:
+                flags |= os.O_NONBLOCK
+            self._fd = os.open(self.devpath, flags)
+        except (IOError, OSError) as e:
+            print("Could not open HID device '{}': {}".format(self.devpath, e))
+            self._schedule_retry(now)
+            return False
+
+        self.opens += 1
+        self._last = None
+        return True
+
+    def _schedule_retry(self, now):
+        self._backoff = min(self._backoff_max,
+            max(self._backoff_min, self._backoff * 2))
+        self._retry_time = now + self._backoff
+
+    def fileno(self):
+        return self._fd
+
+    def retry_delay(self):
+        '''Seconds until the device may be reopened after a failure'''
+        return max(0, self._retry_time - time.time())
+
+    def close(self):
+        if self._fd is not None:
+            try:
+                os.close(self._fd)
+            except OSError:
+                pass
+            self._fd = None
+            self._last = None
+
+    def write(self, report):
+        '''Write one report, reopening the device if needed
+
+        Returns True if written and False if dropped. In non-blocking mode,
+        returns None if the device is busy and the write should be retried.
+        '''
+
+        if self.suppress_identical and report == self._last:
+            self.suppressed += 1
+            return True
+
+        if self._fd is None and not self._open():
+            self.dropped += 1
+            return False
+
+        t0 = time.time()
+        try:
+            os.write(self._fd, report)
+        except (IOError, OSError) as e:
+            if self.nonblock and e.errno == errno.EAGAIN:
+                return None
+
+            print("Dropped report for HID device '{}': {}".format(self.devpath, e))
+            self.dropped += 1
+            self.close()
+            self._schedule_retry(t0)
+            return False
+
+        t1 = time.time()
+        if TRACER is not None:
+            TRACER.written(report, t0, t1)
+
+        self._last = report
+
+        dt = t1 - t0
+        self.writes += 1
+        self.write_time_total += dt
+        if dt > self.write_time_max:
+            self.write_time_max = dt
+        self._backoff = 0
+        return True
+
+    def stats(self):
+        return {
+            "writes": self.writes,
+            "dropped": self.dropped,
+            "opens": self.opens,
+            "suppressed": self.suppressed,
+            "write_time_avg": self.write_time_total / self.writes if self.writes else 0.0,
+            "write_time_max": self.write_time_max,
+        }
+
+
+class ReportQueue(object):
+    '''Bounded FIFO of reports waiting for the host
+
+    When full, reports the host can skip without missing a transition (per
+    'merge_ok', e.g. kb_report_merge_ok) are collapsed, and if none can be,
+    the oldest report is dropped. Given 'merge' (e.g. mouse_report_merge)
+    instead, adjacent reports are merged, clipping motion if need be. Reports
+    it can't merge (button changes) are never dropped, so the queue may grow
+    past 'maxlen'.
+    '''
+
+    def __init__(self, maxlen=REPORT_QUEUE_SIZE, merge_ok=None, merge=None):
+        self.maxlen = maxlen
+        self._merge_ok = merge_ok
+        self._merge = merge
+        self._items = collections.deque()
+
+        # Last report taken off the queue or written directly
+        self.last = None
+
+        # Counters
+        self.queued = 0
+        self.collapsed = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, i):
+        return self._items[i]
+
+    def append(self, report):
+        if len(self._items) >= self.maxlen:
+            if self._merge_ok is not None:
+                self._collapse()
+            elif self._merge is not None:
+                self._merge_adjacent()
+                if len(self._items) >= self.maxlen:
+                    self._merge_oldest()
+
+            if len(self._items) >= self.maxlen and self._merge is None:
+                self._items.popleft()
+                self.dropped += 1
+
+        self._items.append(report)
+        self.queued += 1
+        if len(self._items) > self.max_depth:
+            self.max_depth = len(self._items)
+
+    def popleft(self):
+        self.last = self._items.popleft()
+        return self.last
+
+    def discard(self):
+        '''Drop the oldest report without sending it'''
+        self._items.popleft()
+        self.dropped += 1
+
+    def compact(self):
+        '''Collapse what can be collapsed now, e.g. before sending a backlog'''
+        if len(self._items) > 1:
+            if self._merge_ok is not None:
+                self._collapse()
+            elif self._merge is not None:
+                self._merge_adjacent()
+
+    def _collapse(self):
+        '''Keep only the reports needed for every transition to reach the host'''
+        items = list(self._items)
+        kept = collections.deque()
+        prev = self.last
+        for i, report in enumerate(items[:-1]):
+            if prev is not None and self._merge_ok(prev, report, items[i + 1]):
+                self.collapsed += 1
+                continue
+            kept.append(report)
+            prev = report
+        kept.append(items[-1])
+        self._items = kept
+
+    def _merge_adjacent(self):
+        '''Merge every run of adjacent reports that 'merge' allows'''
+        kept = collections.deque()
+        for report in self._items:
+            merged = self._merge(kept[-1], report) if kept else None
+            if merged is None:
+                kept.append(report)
+            else:
+                kept[-1] = merged
+                self.collapsed += 1
+        self._items = kept
+
+    def _merge_oldest(self):
+        '''Merge the oldest pair of reports 'merge' allows, losing what doesn't fit'''
+        items = self._items
+        for i in xrange(len(items) - 1):
+            merged = self._merge(items[i], items[i + 1], True)
+            if merged is not None:
+                items[i] = merged
+                del items[i + 1]
+                self.dropped += 1
+                return
+
+    def stats(self):
+        return {
+            "queued": self.queued,
+            "collapsed": self.collapsed,
+            "dropped": self.dropped,
+            "max_depth": self.max_depth,
+        }
+
+
+class UdcMonitor(object):
+    '''Follows the USB device controller's state, to tell when the host is asleep
+
+    Reads '<udc>/state' every UDC_POLL_INTERVAL, or right away via check().
+    '''
+
+    def __init__(self, loop, path, interval=UDC_POLL_INTERVAL, remote_wakeup=REMOTE_WAKEUP):
+        self.path = path
+        self.state = None
+        self.remote_wakeup = remote_wakeup
+
+        self._loop = loop
+        self._interval = interval
+        self._listeners = []
+        self._wakeup_time = 0
+
+    @property
+    def configured(self):
+        # Unknown states don't block output
+        return self.state in (None, "configured")
+
+    def add_listener(self, callback):
+        '''Call 'callback(state)' whenever the state changes'''
+        self._listeners.append(callback)
+
+    def start(self):
+        self.check()
+        print("USB device controller state: {}".format(self.state))
+        self._loop.call_later(self._interval, self._poll)
+
+    def check(self):
+        '''Re-read the state now, and return whether the host is listening'''
         try:
-            with open(devpath, 'wb') as fh:
-                fh.write(report)
-        except IOError as e:
-            print("Dropped report for HID device '{}': {}".format(devpath, e))
-        finally:
-            queue.task_done()
+            with open(os.path.join(self.path, "state")) as f:
+                state = f.read().strip()
+        except (IOError, OSError):
+            state = None
+
+        if state != self.state:
+            self.state = state
+            for callback in self._listeners:
+                callback(state)
+
+        return self.configured
+
+    def wakeup(self):
+        '''Ask a suspended host to resume, at most once per poll interval'''
+        now = self._loop.time()
+        if not self.remote_wakeup or self.state != "suspended" or \
+                now - self._wakeup_time < self._interval:
+            return
+
+        self._wakeup_time = now
+        try:
+            with open(os.path.join(self.path, "srp"), "w") as f:
+                f.write("1")
+        except (IOError, OSError) as e:
+            print("Remote wakeup failed: {}".format(e))
+
+    def _poll(self):
+        self.check()
+        self._loop.call_later(self._interval, self._poll)
+
+
+class HidChannel(object):
+    '''Queue-like report sink that writes to a non-blocking HidWriter from the event loop
+
+    Reports wait in 'pending' (a ReportQueue) while the host isn't reading,
+    or while 'udc' (a UdcMonitor) says it is asleep or gone. They are sent,
+    compacted, once it is configured again. A report whose write fails is
+    retried, after the writer's backoff, up to 'retries' times.
+    '''
+
+    def __init__(self, loop, writer, pending=None, udc=None, retries=HID_WRITE_RETRIES):
+        self._loop = loop
+        self._writer = writer
+        self._pending = ReportQueue() if pending is None else pending
+        self._wait_fd = None
+
+        self._retries = retries
+        self._failures = 0
+        self._retry_timer = None
+
+        self._udc = udc
+        if udc is not None:
+            udc.add_listener(self._on_udc_state)
+
+    def put(self, report):
+        if TRACER is not None:
+            report = TRACER.tag(report)
+
+        if self._pending:
+            self._pending.append(report)
+            if self._udc is not None and not self._udc.configured:
+                self._udc.wakeup()
+            return
+
+        if self._udc is not None and not self._udc.configured:
+            self._pending.append(report)
+            self._udc.wakeup()
+            return
+
+        written = self._writer.write(report)
+        if written is None:
+            self._pending.append(report)
+            self._wait()
+        elif not written:
+            # Keep the report, for when the host is back or for a retry
+            self._pending.append(report)
+            if self._udc is None or self._udc.check():
+                self._failed()
+        else:
+            self._pending.last = report
+
+    def stats(self):
+        stats = self._writer.stats()
+        for key, value in self._pending.stats().items():
+            stats["queue_" + key] = value
+        return stats
+
+    def _wait(self):
+        fd = self._writer.fileno()
+        if fd != self._wait_fd:
+            self._stop_waiting()
+            self._loop.add_writer(fd, self._drain)
+            self._wait_fd = fd
+
+    def _stop_waiting(self):
+        if self._wait_fd is not None:
+            self._loop.remove_writer(self._wait_fd)
+            self._wait_fd = None
+
+    def _failed(self):
+        '''Retry the oldest report once the writer may reopen, or drop it after too many tries'''
+        self._stop_waiting()
+        if self._retry_timer is not None:
+            return
+
+        self._failures += 1
+        if self._failures > self._retries:
+            print("Dropped report for HID device '{}' after {} retries.".format(
+                self._writer.devpath, self._retries))
+            self._failures = 0
+            self._pending.discard()
+
+        if self._pending:
+            self._retry_timer = self._loop.call_later(self._writer.retry_delay(),
+                self._retry)
+
+    def _retry(self):
+        self._retry_timer = None
+        self._drain()
+
+    def _drain(self):
+        if self._retry_timer is not None:
+            # A retry is due later
+            return
+
+        while self._pending:
+            if self._udc is not None and not self._udc.configured:
+                break
+
+            written = self._writer.write(self._pending[0])
+            if written is None:
+                self._wait()
+                return
+            if not written:
+                if self._udc is not None and not self._udc.check():
+                    # The host went away: wait for it to be back
+                    break
+                self._failed()
+                return
+
+            self._failures = 0
+            self._pending.popleft()
+
+        self._stop_waiting()
+
+    def _on_udc_state(self, state):
+        if not self._udc.configured:
+            return
+
+        # Reopen, in case the gadget was re-enumerated, and resend even a
+        # report identical to the last one
+        self._writer.close()
+        self._failures = 0
+
+        if self._pending:
+            self._pending.compact()
+            self._drain()
+
+
+class ReportScheduler(object):
+    '''Report sink that paces output with timers instead of blocking
+
+    pause() delays every report put after it, so a translator can queue a
+    whole navigation sequence at once while input keeps being read.
+    '''
+
+    def __init__(self, loop, queue):
+        self._loop = loop
+        self._queue = queue
+        self._pending = collections.deque()  # Reports and pause durations
+        self._timer = None
+        self._last = KB_EMPTY_REPORT
+
+    @property
+    def busy(self):
+        return self._timer is not None
+
+    def put(self, report):
+        if TRACER is not None:
+            report = TRACER.tag(report)
+
+        if self._timer is None:
+            self._send(report)
+        else:
+            self._pending.append(report)
+
+    def pause(self, seconds):
+        if self._timer is None:
+            self._timer = self._loop.call_later(seconds, self._drain)
+        else:
+            self._pending.append(seconds)
+
+    def cancel(self, report=None):
+        '''Drop scheduled output. Returns the last report sent to the host.
+
+        If that drops reports, 'report' (the live keyboard state, or nothing
+        held if None) is sent so no key stays in the state the dropped
+        reports left it in.
+        '''
+        dropped = any(isinstance(item, bytes) for item in self._pending)
+        self._pending.clear()
 
+        if self._timer is not None:
+            self._loop.cancel(self._timer)
+            self._timer = None
+
+        if report is None:
+            report = KB_EMPTY_REPORT
+
+        # Don't leave keys from a dropped press held on the host, or
+        # physically held keys released
+        if dropped and self._last != report:
+            self._send(report)
+
+        return self._last
+
+    def _send(self, report):
+        self._queue.put(report)
+        self._last = report
+
+    def _drain(self):
+        self._timer = None
+        while self._pending:
+            item = self._pending.popleft()
+            if isinstance(item, bytes):
+                self._send(item)
+            else:
+                self._timer = self._loop.call_later(item, self._drain)
+                return
 
-def start_daemon(f, *args, **kwargs):
-    #def f_close_on_error():
-    #    try:
-    #        f(*args, **kwargs)
-    #    finally:
-    #        sys.exit(1)
 
-    #thread = threading.Thread(target=f_close_on_error)
-    thread = threading.Thread(target=f, args=args, kwargs=kwargs)
-    thread.daemon = True
-    thread.start()
-    return thread
+def print_stats(channels, manager, out=None):
+    '''Print the HID channels' and input devices' counters, and latency histograms if tracing'''
+    out = out or sys.stderr
+    for name, channel in channels:
+        stats = channel.stats()
+        print("{}: {}".format(name, ", ".join(
+            "{}={}".format(key, stats[key]) for key in sorted(stats))), file=out)
+
+    stats = manager.stats()
+    print("input: {}".format(", ".join(
+        "{}={}".format(key, stats[key]) for key in sorted(stats))), file=out)
+
+    if TRACER is not None:
+        TRACER.dump(out)
 
 
 ## Main
 
 if __name__ == "__main__":
-    queue = Queue()
+    loop = EventLoop()
+
+    udc = None
+    udc_path = UDC_PATH
+    if udc_path is None and gadget.find_udc():
+        udc_path = os.path.join(gadget.UDC_CLASS_PATH, gadget.find_udc())
+    if udc_path:
+        udc = UdcMonitor(loop, udc_path)
+        udc.start()
+
+    if TRACE_LATENCY:
+        TRACER = LatencyTracer()
+
+    channels = []
+
+    keyboard_channel = HidChannel(loop, HidWriter(HID_KEYBOARD_PATH, nonblock=True),
+        ReportQueue(merge_ok=kb_report_merge_ok), udc)
+    channels.append(("keyboard", keyboard_channel))
+    keyboard = ReportScheduler(loop, keyboard_channel)
+
+    mouse = None
+    if HID_MOUSE_PATH:
+        mouse = HidChannel(loop,
+            HidWriter(HID_MOUSE_PATH, nonblock=True, suppress_identical=False),
+            ReportQueue(merge=mouse_report_merge), udc)
+        channels.append(("mouse", mouse))
 
-    start_daemon(loop_read_input_device, queue, '/dev/input/event0', kbh_tv_menu)
+    consumer = None
+    if HID_CONSUMER_PATH:
+        consumer = HidChannel(loop, HidWriter(HID_CONSUMER_PATH, nonblock=True),
+            ReportQueue(merge_ok=cc_report_merge_ok), udc)
+        channels.append(("consumer", consumer))
 
-    loop_write_usb_hid(queue, '/dev/hidg0')
+    handler = kbh_tv_menu
+    if KEYMAP_PATH:
+        handler = KeymapHandler(loop, KEYMAP_PATH, handler)
+
+    manager = DeviceManager(loop, keyboard, handler, mouse_queue=mouse,
+        consumer_queue=consumer)
+
+    if isinstance(handler, KeymapHandler):
+        handler.on_reload = manager.update_event_mask
+
+    # Counters (and latency histograms) on SIGUSR1 and at exit
+    signal.signal(signal.SIGUSR1, lambda signum, frame: print_stats(channels, manager))
+
+    manager.start()
+
+    try:
+        loop.run()
+    finally:
+        print_stats(channels, manager)
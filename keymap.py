@@ -0,0 +1,210 @@
+'''Declarative key remapping: layers, chords and tap/hold keys
+
+A keymap file is JSON, or YAML if it ends in .yaml/.yml and PyYAML is
+installed:
+
+    {
+        "layers": {
+            "base": {
+                "KEY_CAPSLOCK": "KEY_ESC",
+                "KEY_SPACE": {"tap": "KEY_SPACE", "hold": "layer:nav"}
+            },
+            "nav": {"KEY_H": "KEY_LEFT", "KEY_L": "KEY_RIGHT"}
+        },
+        "chords": [
+            {"keys": ["KEY_J", "KEY_K"], "action": "KEY_ESC"}
+        ],
+        "macros": {
+            "search": "Up, Up, Right, Enter"
+        },
+        "hold_time": 0.2,
+        "chord_time": 0.05
+    }
+
+An action is a key name, "layer:<name>" (the layer is active while the key
+is held), "macro:<name>" (see hid_bridge.kb_macro for the sequence syntax),
+"none", or {"tap": action, "hold": action}. Keys a layer doesn't
+map behave as in the base layer, and keys the base layer doesn't map pass
+through unchanged.
+
+A tap/hold key taps if it is released within hold_time, unless another key
+was pressed and released while it was down. Keys pressed before it is decided
+are held back until then, so typing quickly over it keeps their order.
+
+compile_keymap() turns this into one dense table per layer, indexed by
+scancode, so looking up a key's action is a single index.
+'''
+
+import json
+
+import codes
+
+
+## Constants
+
+# Action kinds, the first item of each compiled action tuple
+KEY = 0         # (KEY, scancode)
+LAYER = 1       # (LAYER, layer index)
+NONE = 2        # (NONE,)
+TAP_HOLD = 3    # (TAP_HOLD, tap action, hold action)
+MACRO = 4       # (MACRO, macro index)
+
+NO_ACTION = (NONE,)
+
+HOLD_TIME = 0.2
+CHORD_TIME = 0.05
+
+BASE_LAYER = "base"
+
+TABLE_SIZE = codes.SCANCODES["KEY_MAX"] + 1
+
+STRING_TYPES = (str, type(u""))
+
+# Unmapped keys send themselves
+PASS_THROUGH = [(KEY, scancode) for scancode in range(TABLE_SIZE)]
+
+
+## Classes
+
+class KeymapError(ValueError):
+    pass
+
+
+class Keymap(object):
+    '''Compiled keymap
+
+    tables[layer][scancode] is the key's action in that layer, and
+    chords[scancode] is None or {partner scancode: action}. macros is a list
+    of (name, sequence) for the bridge to compile into reports.
+    '''
+
+    __slots__ = ("tables", "layer_names", "chords", "macros", "hold_time", "chord_time")
+
+    def __init__(self, tables, layer_names, chords, macros=(), hold_time=HOLD_TIME,
+            chord_time=CHORD_TIME):
+        self.tables = tables
+        self.layer_names = layer_names
+        self.chords = chords
+        self.macros = macros
+        self.hold_time = hold_time
+        self.chord_time = chord_time
+
+
+## Functions
+
+
+def _check(value, types, what):
+    '''Return 'value' if it is one of 'types', otherwise raise KeymapError'''
+    if not isinstance(value, types):
+        raise KeymapError("Invalid {}: {!r}".format(what, value))
+    return value
+
+
+def _scancode(name):
+    _check(name, STRING_TYPES, "key name")
+    try:
+        return codes.SCANCODES[name]
+    except KeyError:
+        raise KeymapError("Unknown key '{}'".format(name))
+
+
+def _seconds(config, name, default):
+    value = config.get(name, default)
+    if isinstance(value, bool):
+        raise KeymapError("Invalid {}: {!r}".format(name, value))
+    return float(_check(value, (int, float), name))
+
+
+def _action(spec, layer_index, macro_index, nested=False):
+    if isinstance(spec, dict) and not nested:
+        try:
+            tap, hold = spec["tap"], spec["hold"]
+        except KeyError:
+            raise KeymapError("Tap/hold action needs 'tap' and 'hold': {}".format(spec))
+        return (TAP_HOLD, _action(tap, layer_index, macro_index, True),
+            _action(hold, layer_index, macro_index, True))
+
+    if not isinstance(spec, STRING_TYPES):
+        raise KeymapError("Invalid action: {!r}".format(spec))
+
+    if spec == "none":
+        return NO_ACTION
+
+    if spec.startswith("layer:"):
+        try:
+            return (LAYER, layer_index[spec[len("layer:"):]])
+        except KeyError:
+            raise KeymapError("Unknown layer in '{}'".format(spec))
+
+    if spec.startswith("macro:"):
+        try:
+            return (MACRO, macro_index[spec[len("macro:"):]])
+        except KeyError:
+            raise KeymapError("Unknown macro in '{}'".format(spec))
+
+    return (KEY, _scancode(spec))
+
+
+def compile_keymap(config):
+    '''Compile a keymap config (as loaded from the file) into a Keymap'''
+
+    _check(config, (dict,), "keymap, expected a mapping")
+
+    layers = _check(config.get("layers", {}), (dict,), "layers, expected a mapping")
+    for name, layer in layers.items():
+        _check(layer, (dict,), "layer '{}', expected a mapping".format(name))
+    names = [BASE_LAYER] + sorted(name for name in layers if name != BASE_LAYER)
+    layer_index = dict((name, i) for i, name in enumerate(names))
+
+    macros = _check(config.get("macros", {}), (dict,), "macros, expected a mapping")
+    macros = sorted(macros.items())
+    for name, spec in macros:
+        _check(spec, STRING_TYPES + (list,), "macro '{}'".format(name))
+        if isinstance(spec, list):
+            for step in spec:
+                _check(step, STRING_TYPES + (int, float), "step in macro '{}'".format(name))
+    macro_index = dict((name, i) for i, (name, _) in enumerate(macros))
+
+    base = list(PASS_THROUGH)
+    for name, spec in layers.get(BASE_LAYER, {}).items():
+        base[_scancode(name)] = _action(spec, layer_index, macro_index)
+
+    tables = [base]
+    for layer in names[1:]:
+        table = list(base)
+        for name, spec in layers[layer].items():
+            table[_scancode(name)] = _action(spec, layer_index, macro_index)
+        tables.append(table)
+
+    chords = [None] * TABLE_SIZE
+    for chord in _check(config.get("chords", []), (list,), "chords, expected a list"):
+        try:
+            keys, spec = chord["keys"], chord["action"]
+        except (KeyError, TypeError):
+            raise KeymapError("Chord needs 'keys' and 'action': {}".format(chord))
+        if not isinstance(keys, list) or len(keys) != 2:
+            raise KeymapError("Chords must have exactly two keys: {}".format(keys))
+
+        a, b = _scancode(keys[0]), _scancode(keys[1])
+        action = _action(spec, layer_index, macro_index, True)
+        for first, second in ((a, b), (b, a)):
+            if chords[first] is None:
+                chords[first] = {}
+            chords[first][second] = action
+
+    return Keymap(tables, names, chords, macros,
+        _seconds(config, "hold_time", HOLD_TIME),
+        _seconds(config, "chord_time", CHORD_TIME))
+
+
+def load(path):
+    '''Read and compile a keymap file'''
+
+    with open(path) as f:
+        if path.endswith((".yaml", ".yml")):
+            import yaml
+            config = yaml.safe_load(f)
+        else:
+            config = json.load(f)
+
+    return compile_keymap(config or {})
@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import descriptors
+import gadget
+
+
+class GadgetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.configfs = tempfile.mkdtemp()
+
+        # Record attribute writes: real configfs rejects some that a temp dir takes
+        self.writes = []
+        self._write = gadget._write
+
+        def write(path, value, mode="w"):
+            self.writes.append((os.path.relpath(path, self.configfs), value))
+            self._write(path, value, mode)
+        gadget._write = write
+
+    def tearDown(self):
+        gadget._write = self._write
+        shutil.rmtree(self.configfs)
+
+    def udc_writes(self):
+        return [value for path, value in self.writes if os.path.basename(path) == "UDC"]
+
+    def read(self, *parts, **kwargs):
+        with open(os.path.join(*parts), kwargs.get("mode", "r")) as f:
+            return f.read()
+
+    def test_create(self):
+        path = gadget.create(configfs=self.configfs, udc="fake.udc")
+
+        self.assertEqual(path, gadget.gadget_path(self.configfs))
+        self.assertEqual(self.read(path, "idVendor"), "0x1d6b")
+        self.assertEqual(self.read(path, "UDC"), "fake.udc")
+
+        config = os.path.join(path, "configs", "c.1")
+        for i, (name, protocol, subclass, length, desc) in enumerate(gadget.hid_functions()):
+            func = os.path.join(path, "functions", "hid.usb{}".format(i))
+            self.assertEqual(self.read(func, "protocol"), str(protocol))
+            self.assertEqual(self.read(func, "subclass"), str(subclass))
+            self.assertEqual(self.read(func, "report_length"), str(length))
+            self.assertEqual(self.read(func, "report_desc", mode="rb"), desc)
+            self.assertEqual(os.readlink(os.path.join(config, "hid.usb{}".format(i))), func)
+
+    def test_create_nkro_keyboard(self):
+        path = gadget.create(functions=("keyboard",), nkro=True, configfs=self.configfs,
+            udc="")
+
+        func = os.path.join(path, "functions", "hid.usb0")
+        self.assertEqual(self.read(func, "report_length"), str(descriptors.NKRO_REPORT_SIZE))
+        self.assertEqual(self.read(func, "report_desc", mode="rb"),
+            descriptors.nkro_descriptor())
+        self.assertFalse(os.path.exists(os.path.join(path, "UDC")))
+
+    def test_create_while_bound(self):
+        gadget.create(configfs=self.configfs, udc="fake.udc")
+        del self.writes[:]
+
+        # Unbinds before rewriting function attributes (EBUSY otherwise), then binds again
+        gadget.create(configfs=self.configfs, udc="fake.udc")
+
+        self.assertEqual(os.path.basename(self.writes[0][0]), "UDC")
+        self.assertEqual(self.udc_writes(), ["\n", "fake.udc"])
+
+    def test_create_twice_unbound(self):
+        path = gadget.create(configfs=self.configfs, udc="")
+        gadget.create(configfs=self.configfs, udc="")
+
+        # Writing an empty UDC to an unbound gadget fails (ENODEV)
+        self.assertEqual(self.udc_writes(), [])
+        self.assertFalse(os.path.exists(os.path.join(path, "UDC")))
+
+    def test_remove(self):
+        path = gadget.create(configfs=self.configfs, udc="fake.udc")
+        gadget.remove(configfs=self.configfs)
+
+        self.assertEqual(self.udc_writes(), ["fake.udc", "\n"])
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(os.listdir(os.path.join(self.configfs, "usb_gadget")), [])
+
+        # Nothing to remove
+        gadget.remove(configfs=self.configfs)
+
+    def test_remove_unbound(self):
+        path = gadget.create(configfs=self.configfs, udc="")
+        gadget.remove(configfs=self.configfs)
+
+        self.assertEqual(self.udc_writes(), [])
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
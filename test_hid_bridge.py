@@ -0,0 +1,410 @@
+import itertools
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import codes
+import descriptors
+import hid_bridge
+
+
+S = codes.SCANCODES
+H = codes.HIDCODES
+
+
+class FakeQueue(object):
+    '''Report sink recording reports (as bytearrays) and pauses'''
+
+    busy = False
+
+    def __init__(self):
+        self.out = []
+
+    def put(self, report):
+        self.out.append(bytearray(report))
+
+    def pause(self, seconds):
+        self.out.append(seconds)
+
+    def cancel(self, report=None):
+        return hid_bridge.KB_EMPTY_REPORT if report is None else report
+
+    def reports(self):
+        return [r for r in self.out if isinstance(r, bytearray)]
+
+
+def boot_report(*usages):
+    '''Boot keyboard report holding 'usages' (HID codes), modifiers included'''
+    state = hid_bridge.KeyboardState()
+    for hk in usages:
+        state.press(hk)
+    return bytearray(state.report)
+
+
+class PlayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pacing_path = hid_bridge.PACING_PATH
+        hid_bridge.PACING_PATH = ""
+
+        self.queue = FakeQueue()
+        self.frames = hid_bridge.FrameQueue(self.queue)
+        self.state = hid_bridge.KeyboardState()
+
+    def tearDown(self):
+        hid_bridge.PACING_PATH = self.pacing_path
+
+    def hold(self, *names):
+        for name in names:
+            hid_bridge.kbh_basic(self.frames, self.state, hid_bridge.SimKeyEvent(S[name], 1))
+        self.frames.flush()
+        del self.queue.out[:]
+
+    def play(self, spec):
+        hid_bridge.kb_play(self.frames, hid_bridge.kb_macro(spec), self.state)
+        self.frames.flush()
+        return self.queue.reports()
+
+    def test_nothing_held(self):
+        macro = hid_bridge.kb_macro("Up, wait:0.5, Right")
+        hid_bridge.kb_play(self.frames, macro, self.state)
+        self.frames.flush()
+
+        self.assertEqual(self.queue.out, [bytearray(step) if isinstance(step, bytes) else step
+            for step in macro.steps])
+        self.assertEqual(self.state.report, boot_report())
+
+    def test_macro_waits(self):
+        macro = hid_bridge.kb_macro("1, wait:0.5, 2")
+        self.assertEqual(macro.ops, ((H["KEY_1"], 1), (H["KEY_1"], 0), 0.5,
+            (H["KEY_2"], 1), (H["KEY_2"], 0)))
+
+        macro = hid_bridge.kb_macro(["Up", 0.25, "WAIT: 1", 103])
+        self.assertEqual(macro.ops, ((H["KEY_UP"], 1), (H["KEY_UP"], 0), 0.25, 1.0,
+            (H["KEY_UP"], 1), (H["KEY_UP"], 0)))
+
+        self.assertRaises(ValueError, hid_bridge.kb_macro, "Up, wait:soon")
+        self.assertRaises(ValueError, hid_bridge.kb_macro, "Up, 0.5")
+
+    def test_held_keys_stay_held(self):
+        self.hold("KEY_LEFTSHIFT", "KEY_A")
+        held = boot_report(H["KEY_LEFTSHIFT"], H["KEY_A"])
+
+        self.assertEqual(self.play("Up"), [
+            boot_report(H["KEY_LEFTSHIFT"], H["KEY_A"], H["KEY_UP"]),
+            held,
+        ])
+        self.assertEqual(self.state.report, held)
+
+    def test_macro_key_held(self):
+        self.hold("KEY_UP")
+        up = boot_report(H["KEY_UP"])
+
+        # Released first, so the macro's press reaches the host, then restored
+        self.assertEqual(self.play("Up"), [boot_report(), up, boot_report(), up])
+        self.assertEqual(self.state.report, up)
+
+    def test_sim_keypress(self):
+        self.hold("KEY_LEFTCTRL")
+        ctrl = boot_report(H["KEY_LEFTCTRL"])
+
+        hid_bridge.kb_sim_keypress(self.frames, S["KEY_UP"], S["KEY_DOWN"], state=self.state)
+        self.frames.flush()
+
+        self.assertEqual(self.queue.reports(), [
+            boot_report(H["KEY_LEFTCTRL"], H["KEY_UP"]),
+            ctrl,
+            boot_report(H["KEY_LEFTCTRL"], H["KEY_DOWN"]),
+            ctrl,
+        ])
+
+    def test_translator_moves_keep_ctrl_held(self):
+        self.hold("KEY_LEFTCTRL")
+
+        translator = hid_bridge.InputHulu(self.queue, self.state)
+        translator.menu_right(self.queue, bump=True)
+        translator.menu_select(self.queue)
+
+        reports = self.queue.reports()
+        self.assertTrue(len(reports) > 2)
+        for report in reports:
+            self.assertEqual(report[0], 0x01)
+        self.assertEqual(reports[-1], boot_report(H["KEY_LEFTCTRL"]))
+        self.assertEqual(self.state.report, boot_report(H["KEY_LEFTCTRL"]))
+
+    def test_translator_releases_held_ctrl(self):
+        # Ctrl held while switching to Hulu mode, then released before typing
+        for name, value in (("KEY_LEFTCTRL", 1), ("KEY_MUTE", 1), ("KEY_MUTE", 0)):
+            hid_bridge.kbh_tv_menu(self.frames, self.state, hid_bridge.SimKeyEvent(S[name], value))
+        self.frames.flush()
+        self.assertIsInstance(self.state.input_translation, hid_bridge.InputHulu)
+        del self.queue.out[:]
+
+        for name, value in (("KEY_LEFTCTRL", 0), ("KEY_A", 1), ("KEY_A", 0)):
+            hid_bridge.kbh_tv_menu(self.frames, self.state, hid_bridge.SimKeyEvent(S[name], value))
+        self.frames.flush()
+
+        # Navigating to "a" doesn't send Ctrl+arrows
+        reports = self.queue.reports()
+        self.assertTrue(len(reports) > 2)
+        for report in reports:
+            self.assertEqual(report[0], 0)
+        self.assertEqual(self.state.report, boot_report())
+
+
+class ModeSwitchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pacing_path = hid_bridge.PACING_PATH
+        hid_bridge.PACING_PATH = ""
+
+        self.queue = FakeQueue()
+        self.frames = hid_bridge.FrameQueue(
+            hid_bridge.ReportScheduler(hid_bridge.EventLoop(), self.queue))
+        self.state = hid_bridge.KeyboardState()
+
+    def tearDown(self):
+        hid_bridge.PACING_PATH = self.pacing_path
+
+    def frame(self, *events):
+        for name, value in events:
+            hid_bridge.kbh_tv_menu(self.frames, self.state,
+                hid_bridge.SimKeyEvent(S[name], value))
+        self.frames.flush()
+
+    def test_switch_during_navigation_keeps_held_keys(self):
+        ctrl = boot_report(H["KEY_LEFTCTRL"])
+        self.frame(("KEY_LEFTCTRL", 1))
+
+        # Homing the YouTube cursor is scheduled over several seconds
+        self.frame(("KEY_VOLUMEDOWN", 1))
+        self.assertTrue(self.frames.busy)
+
+        self.frame(("KEY_VOLUMEUP", 1))
+        self.assertFalse(self.frames.busy)
+        self.assertEqual(self.queue.reports()[-1], ctrl)
+
+    def test_switch_keeps_pending_frame_report(self):
+        self.frame(("KEY_LEFTCTRL", 1), ("KEY_VOLUMEUP", 1))
+
+        self.assertEqual(self.queue.reports(), [boot_report(H["KEY_LEFTCTRL"])])
+
+
+class PlanTest(unittest.TestCase):
+    '''InputTranslator.plan_keys() and type_text() on the YouTube grid'''
+
+    def setUp(self):
+        self.pacing_path = hid_bridge.PACING_PATH
+        hid_bridge.PACING_PATH = ""
+
+        self.queue = FakeQueue()
+        self.translator = hid_bridge.InputYoutube(self.queue, hid_bridge.KeyboardState())
+        del self.queue.out[:]
+
+    def tearDown(self):
+        hid_bridge.PACING_PATH = self.pacing_path
+
+    def layout_keys(self, text):
+        return [self.translator.text_layout_key(ch) for ch in text]
+
+    def plan_cost(self, plan):
+        '''Cost of a plan from the translator's position, or None if it can't be followed'''
+        t = self.translator
+        move_cost, select_cost, swap_cost = t.plan_costs()
+        layouts = (t._layout, t._layout_alt)
+        page, x, y = 0, t._x, t._y
+        cost = 0
+
+        for swap_first, layout_key in plan:
+            steps = [(t.LAYOUT_SWAP, swap_cost)] if swap_first else []
+            for key, key_cost in steps + [(layout_key, select_cost)]:
+                if key not in layouts[page]:
+                    return None
+                target = layouts[page][key]
+                path = layouts[page].path(x, y, target["x"], target["y"])
+                if path is None:
+                    return None
+                cost += len(path) * move_cost + key_cost
+                x, y = target["x"], target["y"]
+                if key == t.LAYOUT_SWAP:
+                    page = 1 - page
+
+        return cost
+
+    def test_type_text_presses(self):
+        self.translator.type_text(self.queue, "star wars 2")
+
+        presses = [r for r in self.queue.reports() if any(r[hid_bridge.KB_KEYS_OFFSET:])]
+        self.assertEqual(len(presses), 68)
+
+    def test_no_swap_for_keys_on_current_page(self):
+        plan = self.translator.plan_keys(self.layout_keys("star wars"))
+        self.assertFalse(any(swap_first for swap_first, _ in plan))
+
+    def test_shared_key_stays_on_current_page(self):
+        # Space is on both pages, so after "2" it is typed without swapping back
+        plan = self.translator.plan_keys(self.layout_keys("2 2"))
+        self.assertEqual([swap_first for swap_first, _ in plan], [True, False, False])
+
+    def test_plan_is_cheapest(self):
+        for text in ("a2", " 2", "2 a", "-2'b", "b 1 z"):
+            layout_keys = self.layout_keys(text)
+            plan = self.translator.plan_keys(layout_keys)
+
+            costs = [self.plan_cost(zip(swaps, layout_keys))
+                for swaps in itertools.product((False, True), repeat=len(layout_keys))]
+            self.assertAlmostEqual(self.plan_cost(plan),
+                min(c for c in costs if c is not None), msg=text)
+
+
+class ConsumerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = FakeQueue()
+        self.consumer = FakeQueue()
+        self.state = hid_bridge.KeyboardState()
+        self.state.consumer = hid_bridge.ConsumerState(self.consumer)
+
+    def tap(self, name):
+        for value in (1, 0):
+            hid_bridge.kbh_basic(self.queue, self.state, hid_bridge.SimKeyEvent(S[name], value))
+
+    def test_kernel_consumer_keys_round_trip(self):
+        kernel_keys = {}
+        for usage, name in codes.HID_INPUT_CONSUMER_KEYS:
+            kernel_keys[usage] = name
+
+        for name, usage in codes.CONSUMERCODES.items():
+            self.assertEqual(kernel_keys[usage], name)
+
+    def test_play_and_pause(self):
+        self.tap("KEY_PLAY")
+        self.tap("KEY_PAUSE")
+
+        self.assertEqual(self.consumer.reports(), [
+            bytearray(b"\xb0\x00"), bytearray(2), bytearray(b"\xb1\x00"), bytearray(2)])
+        self.assertEqual(self.queue.out, [])
+
+    def test_keyboard_keys_stay_on_keyboard(self):
+        self.tap("KEY_UP")
+
+        self.assertEqual(self.consumer.out, [])
+        self.assertEqual(self.queue.reports(), [boot_report(H["KEY_UP"]), boot_report()])
+
+
+def mouse_report(buttons, dx=0, dy=0, wheel=0):
+    return struct.pack(descriptors.MOUSE_REPORT_FORMAT, buttons, dx, dy, wheel)
+
+
+class MouseQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pending = hid_bridge.ReportQueue(maxlen=3, merge=hid_bridge.mouse_report_merge)
+
+    def contents(self):
+        return [struct.unpack(descriptors.MOUSE_REPORT_FORMAT, r) for r in self.pending]
+
+    def test_motion_merges_when_full(self):
+        for report in (mouse_report(0, 10), mouse_report(0, 10), mouse_report(1),
+                mouse_report(1, 0, 5), mouse_report(0, 3)):
+            self.pending.append(report)
+
+        self.assertEqual(self.contents(), [(0, 20, 0, 0), (1, 0, 5, 0), (0, 3, 0, 0)])
+        self.assertEqual(self.pending.dropped, 0)
+
+    def test_button_changes_are_never_dropped(self):
+        for buttons in (1, 0, 1, 0, 1, 0):
+            self.pending.append(mouse_report(buttons))
+
+        self.assertEqual([r[0] for r in self.contents()], [1, 0, 1, 0, 1, 0])
+
+    def test_motion_clipped_as_a_last_resort(self):
+        for _ in xrange(4):
+            self.pending.append(mouse_report(0, 100))
+
+        self.assertEqual(self.contents(), [(0, 127, 0, 0), (0, 100, 0, 0), (0, 100, 0, 0)])
+        self.assertEqual(self.pending.dropped, 1)
+
+
+class SuspendTest(unittest.TestCase):
+    '''HidChannel with a temp file as the gadget and a temp UDC 'state' file'''
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.hidg = os.path.join(self.dir, "hidg0")
+        open(self.hidg, "w").close()
+
+        self.loop = hid_bridge.EventLoop()
+        self.set_udc_state("configured")
+        self.udc = hid_bridge.UdcMonitor(self.loop, self.dir)
+        self.udc.check()
+
+        self.writer = hid_bridge.HidWriter(self.hidg, nonblock=True, backoff_min=0.01,
+            backoff_max=0.02)
+        self.channel = hid_bridge.HidChannel(self.loop, self.writer,
+            hid_bridge.ReportQueue(maxlen=16), self.udc)
+
+        self.reports = [boot_report(H["KEY_A"] + i) for i in xrange(8)]
+
+    def tearDown(self):
+        self.writer.close()
+        shutil.rmtree(self.dir)
+
+    def set_udc_state(self, state):
+        with open(os.path.join(self.dir, "state"), "w") as f:
+            f.write(state + "\n")
+
+    def run_loop(self, seconds=0.5):
+        self.loop.call_later(seconds, self.loop.stop)
+        self.loop.run()
+
+    def written(self):
+        with open(self.hidg, "rb") as f:
+            data = bytearray(f.read())
+        return [data[i:i + 8] for i in xrange(0, len(data), 8)]
+
+    def suspend_and_queue(self):
+        self.set_udc_state("suspended")
+        self.udc.check()
+        for report in self.reports:
+            self.channel.put(bytes(report))
+
+    def test_reports_sent_on_resume(self):
+        self.suspend_and_queue()
+        self.assertEqual(self.written(), [])
+
+        self.set_udc_state("configured")
+        self.udc.check()
+        self.run_loop(0.1)
+
+        self.assertEqual(self.written(), self.reports)
+
+    def test_transient_failure_after_resume(self):
+        self.suspend_and_queue()
+
+        # The gadget node is gone for a moment while it is re-enumerated
+        os.unlink(self.hidg)
+        self.loop.call_later(0.02, lambda: open(self.hidg, "w").close())
+
+        self.set_udc_state("configured")
+        self.udc.check()
+        self.run_loop()
+
+        self.assertEqual(self.written(), self.reports)
+        self.assertEqual(self.channel.stats()["queue_dropped"], 0)
+
+    def test_reports_dropped_after_retries(self):
+        os.unlink(self.hidg)
+        for report in self.reports[:2]:
+            self.channel.put(bytes(report))
+        self.run_loop()
+
+        stats = self.channel.stats()
+        self.assertEqual(stats["writes"], 0)
+        self.assertEqual(stats["queue_dropped"], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
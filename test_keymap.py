@@ -0,0 +1,274 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import codes
+import hid_bridge
+import keymap
+
+
+S = codes.SCANCODES
+
+
+class FakeLoop(hid_bridge.EventLoop):
+    '''Event loop on a clock that only moves when told to'''
+
+    def __init__(self):
+        super(FakeLoop, self).__init__()
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+        self._run_timers()
+
+
+class FakeQueue(object):
+    '''Report sink recording reports (as bytearrays) and pauses'''
+
+    busy = False
+
+    def __init__(self):
+        self.out = []
+
+    def put(self, report):
+        self.out.append(bytearray(report))
+
+    def pause(self, seconds):
+        self.out.append(seconds)
+
+
+class CompileTest(unittest.TestCase):
+
+    def test_pass_through(self):
+        km = keymap.compile_keymap({})
+
+        self.assertEqual(km.layer_names, ["base"])
+        self.assertEqual(km.tables[0][S["KEY_A"]], (keymap.KEY, S["KEY_A"]))
+        self.assertIsNone(km.chords[S["KEY_A"]])
+
+    def test_actions(self):
+        km = keymap.compile_keymap({
+            "layers": {
+                "base": {
+                    "KEY_CAPSLOCK": "KEY_ESC",
+                    "KEY_SPACE": {"tap": "KEY_SPACE", "hold": "layer:nav"},
+                    "KEY_F1": "macro:search",
+                    "KEY_F2": "none",
+                },
+                "nav": {"KEY_H": "KEY_LEFT"},
+            },
+            "chords": [{"keys": ["KEY_J", "KEY_K"], "action": "KEY_ESC"}],
+            "macros": {"search": "Up, Enter"},
+            "hold_time": 0.3,
+        })
+        base, nav = km.tables
+
+        self.assertEqual(km.layer_names, ["base", "nav"])
+        self.assertEqual(base[S["KEY_CAPSLOCK"]], (keymap.KEY, S["KEY_ESC"]))
+        self.assertEqual(base[S["KEY_SPACE"]],
+            (keymap.TAP_HOLD, (keymap.KEY, S["KEY_SPACE"]), (keymap.LAYER, 1)))
+        self.assertEqual(base[S["KEY_F1"]], (keymap.MACRO, 0))
+        self.assertEqual(base[S["KEY_F2"]], keymap.NO_ACTION)
+        self.assertEqual(km.macros, [("search", "Up, Enter")])
+        self.assertEqual(km.hold_time, 0.3)
+        self.assertEqual(km.chord_time, keymap.CHORD_TIME)
+
+        # Layers inherit the base layer
+        self.assertEqual(nav[S["KEY_H"]], (keymap.KEY, S["KEY_LEFT"]))
+        self.assertEqual(nav[S["KEY_CAPSLOCK"]], (keymap.KEY, S["KEY_ESC"]))
+        self.assertEqual(base[S["KEY_H"]], (keymap.KEY, S["KEY_H"]))
+
+        self.assertEqual(km.chords[S["KEY_J"]], {S["KEY_K"]: (keymap.KEY, S["KEY_ESC"])})
+        self.assertEqual(km.chords[S["KEY_K"]], {S["KEY_J"]: (keymap.KEY, S["KEY_ESC"])})
+
+    def test_errors(self):
+        for config in (
+            [],
+            {"layers": {"base": {"KEY_NOPE": "KEY_A"}}},
+            {"layers": {"base": {"KEY_A": "KEY_NOPE"}}},
+            {"layers": {"base": {"KEY_A": "layer:nope"}}},
+            {"layers": {"base": {"KEY_A": "macro:nope"}}},
+            {"layers": {"base": {"KEY_A": {"tap": "KEY_B"}}}},
+            {"layers": {"base": {"KEY_A": {"tap": {"tap": "KEY_B", "hold": "KEY_C"},
+                "hold": "KEY_C"}}}},
+            {"chords": [{"keys": ["KEY_A"], "action": "KEY_B"}]},
+            {"chords": [{"keys": ["KEY_A", "KEY_B"]}]},
+            {"hold_time": "long"},
+            {"hold_time": True},
+            {"macros": {"search": 1}},
+        ):
+            self.assertRaises(keymap.KeymapError, keymap.compile_keymap, config)
+
+
+class KeymapHandlerTest(unittest.TestCase):
+
+    CONFIG = {
+        "layers": {
+            "base": {
+                "KEY_CAPSLOCK": "KEY_ESC",
+                "KEY_SPACE": {"tap": "KEY_SPACE", "hold": "layer:nav"},
+                "KEY_F1": "macro:enter",
+            },
+            "nav": {"KEY_H": "KEY_LEFT"},
+        },
+        "chords": [{"keys": ["KEY_J", "KEY_K"], "action": "KEY_ESC"}],
+        "macros": {"enter": "Enter"},
+        "hold_time": 0.2,
+        "chord_time": 0.05,
+    }
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "keymap.json")
+        self.write(self.CONFIG)
+
+        self.loop = FakeLoop()
+        self.queue = FakeQueue()
+        self.events = []
+
+        def inner(queue, state, data):
+            self.events.append((data.code, data.value))
+        inner.__name__ = "inner"
+
+        self.handler = hid_bridge.KeymapHandler(self.loop, self.path, inner)
+
+    def tearDown(self):
+        inotify = getattr(self.handler, "_inotify", None)
+        if inotify is not None:
+            os.close(inotify.fileno())
+        shutil.rmtree(self.dir)
+
+    def write(self, config):
+        with open(self.path, "w") as f:
+            json.dump(config, f)
+
+    def key(self, name, value, wait=0.0):
+        self.handler(self.queue, None, hid_bridge.SimKeyEvent(S[name], value))
+        self.loop.advance(wait)
+
+    def tap(self, name, wait=0.0):
+        self.key(name, 1)
+        self.key(name, 0, wait)
+
+    def assertEvents(self, *events):
+        self.assertEqual(self.events, [(S[name], value) for name, value in events])
+        del self.events[:]
+
+    def test_remap(self):
+        self.tap("KEY_CAPSLOCK")
+        self.tap("KEY_A")
+        self.assertEvents(("KEY_ESC", 1), ("KEY_ESC", 0), ("KEY_A", 1), ("KEY_A", 0))
+
+    def test_repeat(self):
+        self.key("KEY_CAPSLOCK", 1)
+        self.key("KEY_CAPSLOCK", 2)
+        self.key("KEY_CAPSLOCK", 0)
+        self.assertEvents(("KEY_ESC", 1), ("KEY_ESC", 2), ("KEY_ESC", 0))
+
+    def test_macro(self):
+        self.tap("KEY_F1")
+
+        self.assertEvents()
+        self.assertEqual(len(self.queue.out), 2)
+        self.assertEqual(self.queue.out[0][hid_bridge.KB_KEYS_OFFSET], codes.HIDCODES["KEY_ENTER"])
+        self.assertFalse(any(self.queue.out[1]))
+
+    def test_tap(self):
+        self.key("KEY_SPACE", 1, 0.1)
+        self.assertEvents()
+
+        self.key("KEY_SPACE", 0)
+        self.assertEvents(("KEY_SPACE", 1), ("KEY_SPACE", 0))
+
+    def test_tap_rolled_over(self):
+        # Typing " a" quickly: A goes down before Space comes up
+        self.key("KEY_SPACE", 1, 0.05)
+        self.key("KEY_A", 1, 0.05)
+        self.assertEvents()
+
+        self.key("KEY_SPACE", 0, 0.05)
+        self.key("KEY_A", 0)
+        self.assertEvents(("KEY_SPACE", 1), ("KEY_A", 1), ("KEY_SPACE", 0), ("KEY_A", 0))
+
+    def test_hold_timeout(self):
+        self.key("KEY_SPACE", 1, 0.1)
+        self.key("KEY_H", 1, 0.15)
+
+        # Held past hold_time: the layer applies to the key held back meanwhile
+        self.assertEvents(("KEY_LEFT", 1))
+
+        self.key("KEY_H", 0)
+        self.key("KEY_SPACE", 0)
+        self.tap("KEY_H")
+        self.assertEvents(("KEY_LEFT", 0), ("KEY_H", 1), ("KEY_H", 0))
+
+    def test_hold_nested(self):
+        # Another key pressed and released within the tap/hold key is a hold
+        self.key("KEY_SPACE", 1, 0.05)
+        self.key("KEY_H", 1, 0.05)
+        self.key("KEY_H", 0)
+        self.assertEvents(("KEY_LEFT", 1), ("KEY_LEFT", 0))
+
+        self.key("KEY_SPACE", 0)
+        self.assertEvents()
+
+    def test_chord(self):
+        self.key("KEY_J", 1, 0.01)
+        self.key("KEY_K", 1)
+        self.key("KEY_J", 0)
+        self.key("KEY_K", 0)
+        self.assertEvents(("KEY_ESC", 1), ("KEY_ESC", 0))
+
+    def test_chord_timeout(self):
+        self.key("KEY_J", 1, 0.1)
+        self.assertEvents(("KEY_J", 1))
+
+        # K waits for a partner of its own
+        self.key("KEY_K", 1)
+        self.key("KEY_J", 0)
+        self.key("KEY_K", 0)
+        self.assertEvents(("KEY_J", 0), ("KEY_K", 1), ("KEY_K", 0))
+
+    def test_chord_other_key(self):
+        self.key("KEY_J", 1)
+        self.key("KEY_A", 1)
+        self.assertEvents(("KEY_J", 1), ("KEY_A", 1))
+
+    def test_reload(self):
+        reloads = []
+        self.handler.on_reload = lambda: reloads.append(True)
+
+        self.write({"layers": {"base": {"KEY_CAPSLOCK": "KEY_LEFTCTRL"}}})
+        self.handler.reload()
+        self.tap("KEY_CAPSLOCK")
+        self.assertEvents(("KEY_LEFTCTRL", 1), ("KEY_LEFTCTRL", 0))
+        self.assertEqual(reloads, [True])
+
+        # An invalid keymap leaves the last one in use
+        with open(self.path, "w") as f:
+            f.write("{")
+        self.handler.reload()
+        self.tap("KEY_CAPSLOCK")
+        self.assertEvents(("KEY_LEFTCTRL", 1), ("KEY_LEFTCTRL", 0))
+        self.assertEqual(reloads, [True])
+
+    def test_reload_pending(self):
+        # A key still undecided is resolved with the keymap it was pressed under
+        self.key("KEY_SPACE", 1)
+        self.key("KEY_H", 1)
+        self.write({})
+        self.handler.reload()
+        self.assertEvents(("KEY_LEFT", 1))
+
+        self.key("KEY_H", 0)
+        self.key("KEY_SPACE", 0)
+        self.assertEvents(("KEY_LEFT", 0))
+
+
+if __name__ == "__main__":
+    unittest.main()